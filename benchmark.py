@@ -0,0 +1,128 @@
+#%%
+import argparse, sys, os, time, numpy as np, torch
+from models.models import run_inference
+from utils import bcolors
+
+def check_params(args=None):
+  parser = argparse.ArgumentParser(description='Pipeline Benchmarks')
+
+  parser.add_argument('-bench', metavar='bench', default='collect', choices=['collect', 'onnx', 'packing'], help='Benchmark to run')
+  parser.add_argument('-n', metavar='examples', default=200000, type=int, help='Number of examples')
+  parser.add_argument('-dim', metavar='dimension', default=64, type=int, help='Encoding size')
+  parser.add_argument('-bs', metavar='batch_size', default=200, type=int, help='Batch Size')
+  parser.add_argument('-l', metavar='language', default='EN', help='Encoder language')
+  parser.add_argument('-wp', metavar='weight_path', help='Encoder weights (.pt)')
+  parser.add_argument('-onnx', metavar='onnx_path', help='ONNX graph of the Encoder, exported from -wp if missing')
+  parser.add_argument('-dp', metavar='data_path', help='Split whose tweets are encoded')
+  parser.add_argument('-ml', metavar='max_length', default=120, type=int, help='Maximun Tweets Length')
+  parser.add_argument('-interm_layer', metavar='int_layer', default=64, type=int, help='Intermediate layers neurons')
+  parser.add_argument('-tmode', metavar='tmode', default='online', help='Encoder Weights Mode')
+  parser.add_argument('-threads', metavar='threads', default=None, type=int, help='CPU threads for both runtimes')
+  parser.add_argument('-pack', metavar='pack_length', default=256, type=int, help='Tokens per packed sequence')
+  return parser.parse_args(args)
+
+def report(name, seconds, examples):
+  print(f'{name:<32} {seconds*1000:10.1f} ms {examples/seconds:14.1f} examples/s')
+
+def bench_collect(n, dim, batch_size):
+
+  '''
+    Cost of collecting encodings alone: torch.cat accumulation, as get_encodings used to do, against
+    run_inference writing each batch into a preallocated array. Batches are made up front so only the
+    copying is measured.
+  '''
+  batches = [torch.randn(min(batch_size, n - i), dim) for i in range(0, n, batch_size)]
+
+  start = time.perf_counter()
+  with torch.no_grad():
+    out = None
+    for k, batch in enumerate(batches):
+      out = batch if k == 0 else torch.cat((out, batch), 0)
+    out = out.cpu().numpy()
+  report('torch.cat accumulation', time.perf_counter() - start, n)
+
+  start = time.perf_counter()
+  pre = run_inference(batches, lambda batch: batch, n)
+  report('preallocated (run_inference)', time.perf_counter() - start, n)
+
+  assert np.array_equal(out, pre)
+
+def bench_onnx(weights, graph, data_path, n, batch_size, language, max_length, interm_size, mode_weigth, threads):
+
+  '''
+    Eager Encoder against OnnxEncoder on the first n tweets of data_path: get_encodings throughput, single
+    tweet latency and the largest difference between their encodings.
+  '''
+  from models.models import Encoder, OnnxEncoder
+  from utils import load_corpus_cache
+
+  if threads is not None:
+    torch.set_num_threads(threads)
+  tweets = load_corpus_cache(data_path).tweets()[:n]
+  eager = Encoder(interm_size, max_length, language, mode_weigth)
+  eager.load(weights)
+  eager.eval()
+  if os.path.isfile(graph) == False:
+    eager.export_onnx(graph)
+
+  encodings = {}
+  for name, model in [('eager', eager), ('onnx', OnnxEncoder(graph, threads))]:
+    model.get_encodings(tweets[:batch_size], batch_size)
+
+    start = time.perf_counter()
+    encodings[name], _ = model.get_encodings(tweets, batch_size)
+    report(f'{name} get_encodings', time.perf_counter() - start, len(tweets))
+
+    latency = []
+    with torch.inference_mode():
+      for tweet in tweets[:100]:
+        ids = model.tokenizer([tweet], return_tensors='pt', truncation=True, max_length=max_length)
+        start = time.perf_counter()
+        if name == 'eager':
+          model.forward({'input_ids': ids['input_ids'], 'attention_mask': ids['attention_mask']}, True)
+        else: model.forward(ids)
+        latency.append(time.perf_counter() - start)
+    print(f'{name} single tweet latency: p50 {np.percentile(latency, 50)*1000:.2f} ms p95 {np.percentile(latency, 95)*1000:.2f} ms')
+
+  print(f'max |eager - onnx|: {np.abs(encodings["eager"] - encodings["onnx"]).max():.2e}')
+
+def bench_packing(weights, data_path, n, batch_size, language, max_length, interm_size, mode_weigth, pack_length):
+
+  '''
+    Encoder.get_encodings one tweet per row against packed sequences on the first n tweets of data_path:
+    real (non padding) tokens/s of each and how far apart the encodings are. Run it with -l ES for the BERT
+    (BETO) encoder and -l EN for the RoBERTa (BERTweet) one, their position ids differ.
+  '''
+  from models.models import Encoder, pretokenize
+  from utils import load_corpus_cache
+
+  tweets = load_corpus_cache(data_path).tweets()[:n]
+  model = Encoder(interm_size, max_length, language, mode_weigth)
+  model.load(weights)
+  tokens = len(pretokenize(model.tokenizer, tweets, max_length)[0])
+  packs = max(1, batch_size*max_length//pack_length)
+
+  encodings = {}
+  for name, options in [('per tweet', {'batch_size': batch_size}), (f'packed ({pack_length})', {'batch_size': packs, 'pack_length': pack_length})]:
+    model.get_encodings(tweets[:batch_size], **options)
+    start = time.perf_counter()
+    encodings[name], _ = model.get_encodings(tweets, **options)
+    seconds = time.perf_counter() - start
+    report(name, seconds, len(tweets))
+    print(f'{"":<32} {tokens/seconds:27.1f} tokens/s')
+
+  a, b = encodings.values()
+  cosine = (a*b).sum(-1)/np.maximum(np.linalg.norm(a, axis=-1)*np.linalg.norm(b, axis=-1), 1e-12)
+  print(f'max |per tweet - packed|: {np.abs(a - b).max():.2e} min cosine: {cosine.min():.6f}')
+
+if __name__ == '__main__':
+
+  parameters = check_params(sys.argv[1:])
+  print(f'{bcolors.BOLD}{parameters.bench}: n={parameters.n} dim={parameters.dim} bs={parameters.bs}{bcolors.ENDC}')
+
+  if parameters.bench == 'collect':
+    bench_collect(parameters.n, parameters.dim, parameters.bs)
+  elif parameters.bench == 'onnx':
+    bench_onnx(parameters.wp, parameters.onnx, parameters.dp, parameters.n, parameters.bs, parameters.l, parameters.ml, parameters.interm_layer, parameters.tmode, parameters.threads)
+  elif parameters.bench == 'packing':
+    bench_packing(parameters.wp, parameters.dp, parameters.n, parameters.bs, parameters.l, parameters.ml, parameters.interm_layer, parameters.tmode, parameters.pack)
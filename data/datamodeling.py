@@ -49,19 +49,78 @@ def save_csvs(pclass, nclass, split, path, criterion):
     dev = pd.DataFrame({'tweets':dev_examples[perm], 'label':dev_labels[perm]})
     dev.to_csv(path+'dev.csv')
 
+def count_criterion(csv_file, usecols, label, values, criterion, chunksize=100000):
+
+    '''
+        Cheap pre-pass over csv_file reading only the label and criterion columns. Returns how many rows
+        of each class (index in values) share each criterion value, as partition counts them.
+    '''
+    columns = pd.read_csv(csv_file, usecols=usecols, nrows=0).columns
+    times = Counter()
+    for chunk in pd.read_csv(csv_file, iterator=True, chunksize=chunksize, usecols=list(dict.fromkeys([label, columns[criterion]]))):
+        for cls, value in enumerate(values):
+            times.update((cls, i) for i in chunk[chunk[label] == value][columns[criterion]])
+    return times
+
+def stream_partition(csv_file, usecols, label, values, split, path, criterion, chunksize=1000, bucket_rows=100000):
+
+    '''
+        One-pass version of reading both classes and calling save_csvs. values holds the positive and the
+        negative value of the label column. Rows are routed chunk by chunk: the first int(count*split)
+        rows of each class and criterion value go to train, the rest to dev, and every routed row lands in
+        a random bucket file. Each bucket is shuffled on its own when writing train.csv and dev.csv, which
+        gives a uniform shuffle while holding at most one chunk or one bucket in memory.
+    '''
+    times = count_criterion(csv_file, usecols, label, values, criterion)
+    quota = Counter({i: int(times[i]*split) for i in times})
+    sizes = {'train': sum(quota.values()), 'dev': sum(times.values()) - sum(quota.values())}
+    buckets = {i: max(1, -(-sizes[i]//bucket_rows)) for i in sizes}
+
+    tmp = os.path.join(path, '.partition')
+    if os.path.isdir(tmp) == False:
+        os.makedirs(tmp)
+    bucket_file = lambda phase, k: os.path.join(tmp, f'{phase}_{k}.csv')
+    for phase in buckets:
+        for k in range(buckets[phase]):
+            pd.DataFrame({'tweets': [], 'label': []}).to_csv(bucket_file(phase, k), index=False)
+
+    columns = pd.read_csv(csv_file, usecols=usecols, nrows=0).columns
+    for chunk in pd.read_csv(csv_file, iterator=True, chunksize=chunksize, usecols=usecols):
+        for cls, value in enumerate(values):
+            rows = chunk[chunk[label] == value]
+            if len(rows) == 0:
+                continue
+            crit = rows[columns[criterion]]
+            seen = np.array([quota[(cls, i)] for i in crit]) - rows.groupby(columns[criterion], dropna=False).cumcount().to_numpy()
+            for i, n in crit.value_counts(dropna=False).items():
+                quota[(cls, i)] = max(0, quota[(cls, i)] - n)
+
+            routed = pd.DataFrame({'tweets': rows[columns[0]].to_numpy(), 'label': np.full((len(rows),), 1 - cls, dtype=int)})
+            for phase, mask in (('train', seen > 0), ('dev', seen <= 0)):
+                part = routed[mask]
+                target = np.random.randint(buckets[phase], size=len(part))
+                for k in np.unique(target):
+                    part[target == k].to_csv(bucket_file(phase, k), mode='a', header=False, index=False)
+
+    for phase in buckets:
+        index = 0
+        with open(path + f'{phase}.csv', 'w') as file:
+            file.write(',tweets,label\n')
+            for k in range(buckets[phase]):
+                part = pd.read_csv(bucket_file(phase, k), dtype={'tweets': object}, keep_default_na=False)
+                part = part.iloc[np.random.permutation(len(part))]
+                part.index = range(index, index + len(part))
+                part.to_csv(file, header=False)
+                index += len(part)
+                os.remove(bucket_file(phase, k))
+    os.rmdir(tmp)
+    print(f'{bcolors.OKBLUE}Partitioned {sizes["train"]} train and {sizes["dev"]} dev examples from {csv_file}{bcolors.ENDC}')
+
 def save_fake_en(path):
-    iter_csv = pd.read_csv(path + 'claimskg_result.csv', iterator=True, chunksize=1000, usecols=['text', 'ratingName', 'source'])
-    fake = pd.concat([chunk[chunk['ratingName'] == 'FALSE'] for chunk in iter_csv]).to_numpy()
-    iter_csv = pd.read_csv(path + 'claimskg_result.csv', iterator=True, chunksize=1000, usecols=['text', 'ratingName', 'source'])
-    nofake = pd.concat([chunk[chunk['ratingName'] == 'TRUE'] for chunk in iter_csv]).to_numpy()
-    save_csvs(fake, nofake, 0.8, path, 2)
+    stream_partition(path + 'claimskg_result.csv', ['text', 'ratingName', 'source'], 'ratingName', ['FALSE', 'TRUE'], 0.8, path, 2)
 
 def save_bot_en(path):
-    iter_csv = pd.read_csv(path + 'training_data_2_csv_UTF.csv', iterator=True, chunksize=1000, usecols=['description', 'bot', 'verified'])
-    bot = pd.concat([chunk[chunk['bot'] == 1] for chunk in iter_csv]).to_numpy()
-    iter_csv = pd.read_csv(path + 'training_data_2_csv_UTF.csv', iterator=True, chunksize=1000, usecols=['description', 'bot', 'verified'])
-    nobot = pd.concat([chunk[chunk['bot'] == 0] for chunk in iter_csv]).to_numpy()
-    save_csvs(bot, nobot, 0.8, path, 1)
+    stream_partition(path + 'training_data_2_csv_UTF.csv', ['description', 'bot', 'verified'], 'bot', [1, 0], 0.8, path, 1)
 
 def save_hate(path):
     dev = pd.read_csv(path + f'hateval2019_{path[-3:-1]}_dev.csv', usecols=['text', 'HS']).to_numpy()
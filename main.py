@@ -1,14 +1,15 @@
 #%%
-import argparse, sys, os, numpy as np, torch, random
+import argparse, sys, os, time, numpy as np, torch, random
 from matplotlib.pyplot import axis
-from models.models import Encoder, train_Encoder
-from utils import plot_training, load_Profiling_Data, make_pairs
-from utils import make_triplets,make_profile_pairs, save_predictions, read_embedding, translate_char
-from utils import make_pairs_with_protos, compute_centers_PSC, read_data, translate_words
+from models.models import Encoder, EncodingCache, OnnxEncoder, train_Encoder, train_Exits, early_exit_report, cache_teacher
+from utils import plot_training, load_Profiling_Data, iter_Profiling_Data, load_corpus_cache, group_by_author, make_pairs
+from utils import make_triplets,make_profile_pairs, save_predictions, load_embedding, load_token_cache
+from utils import make_pairs_with_protos, compute_centers_PSC, read_data, restrict_embedding
 from sklearn.metrics import f1_score
 from models.classifiers import K_Impostor, train_classifier, predict, FNN_Classifier, LSTMAtt_Classifier
 from models.classifiers import svm
-from models.Sequential import SeqEncoder, train_Seq
+from models.Sequential import SeqEncoder, train_Seq, train_Distill, load_vocab
+from models.registry import load_fine_tuned
 from sklearn.model_selection import StratifiedKFold
 from sklearn.metrics import classification_report, accuracy_score
 from utils import bcolors
@@ -44,10 +45,38 @@ def check_params(args=None):
   parser.add_argument('-dt', metavar='data_test', help='Get Data for test')
   parser.add_argument('-up', metavar='useof_prototype', help='Using Prototipes for Impostor or compare to random examples', default="prototipical", choices=["prototipical", "random"])
   parser.add_argument('-lstm_size', metavar='LSTM_hidden_size', type=int,help='LSTM classfifier hidden size')
+  parser.add_argument('-encode_by', metavar='encode_by', help='Encoder encode phase: one flattened stream of every tweet in the split or one pass per author', default='corpus', choices=['corpus', 'author'])
+  parser.add_argument('-vocab', metavar='vocabulary', help='Word embedding rows to load on CNN_LSTM_Encoder, all of them or only those seen in the training corpus', default='full', choices=['full', 'corpus'])
+  parser.add_argument('-enc_cache', metavar='encoding_cache', help='SQLite file caching Encoder encodings by tweet text and weights, disabled if not set', default=None)
+  parser.add_argument('-enc_cache_size', metavar='encoding_cache_size', help='Maximum number of encodings kept in the cache', type=int, default=5000000)
+  parser.add_argument('-precision', metavar='precision', help='Encoder inference precision on CPU, int8 dynamic quantization or bf16 autocast', default='fp32', choices=['fp32', 'int8', 'bf16'])
+  parser.add_argument('-backend', metavar='backend', help='Encoder encode phase runtime, eager PyTorch or ONNX Runtime over the graph written by the export phase', default='torch', choices=['torch', 'onnx'])
+  parser.add_argument('-threads', metavar='threads', help='ONNX Runtime intra-op threads', type=int, default=None)
+  parser.add_argument('-amp', help='Encoder training under autocast mixed precision, fp16 on GPU and bf16 on CPU', action='store_true')
+  parser.add_argument('-accumulation', metavar='accumulation', help='Batches whose gradients are accumulated per optimizer step on Encoder training', type=int, default=1)
+  parser.add_argument('-ckpt_steps', metavar='checkpoint_steps', help='Also checkpoint Encoder training every this many batches, besides every epoch', type=int, default=None)
+  parser.add_argument('-frozen', metavar='frozen_layers', help='Encoder training with the embeddings and this many transformer layers frozen, their output cached once (12 or more trains only the heads on [CLS] states)', type=int, default=None)
+  parser.add_argument('-registry', help='Load fine-tuned models for the encode phases from the local registry (safetensors), registering them on first use', action='store_true')
+  parser.add_argument('-pack', metavar='pack_length', help='Encoder encode phase packing several tweets per sequence of up to this many tokens', type=int, default=None)
+  parser.add_argument('-teacher', metavar='teacher', help='Encoder weights distilled by the CNN_LSTM_Encoder distill phase, the task encoder under the Encoder logs by default', default=None)
+  parser.add_argument('-distilled', help='CNN_LSTM_Encoder encode phase with the student trained by the distill phase, saved under logs/distilled', action='store_true')
+  parser.add_argument('-exits', metavar='exit_layers', help='Comma separated transformer layers with an exit head, trained jointly on the encoder train phase or post hoc on the exits phase', default=None)
+  parser.add_argument('-exit_threshold', metavar='exit_threshold', help='Encoder encode phase confidence for leaving through an exit head', type=float, default=None)
   return parser.parse_args(args)
 
 
-def get_encodings(model, mod_name):
+def load_model(name, make, weights):
+
+  '''
+    make() the model and load its weights, or go through the registry when -registry is set.
+  '''
+  if registry == True:
+    return load_fine_tuned(name, make, weights)
+  model = make()
+  model.load(weights)
+  return model
+
+def get_encodings(make, mod_name):
 
   encodings_train = None
   encodings_dev = None
@@ -63,23 +92,83 @@ def get_encodings(model, mod_name):
   elif 'c' in rep:
     encodings_train = torch.load(f'logs/cnn_lstm/{task}_train_encodings_{language[:2]}.pt')
     encodings_dev = torch.load(f'logs/cnn_lstm/{task}_dev_encodings_{language[:2]}.pt')
+  elif 'd' in rep:
+    encodings_train = torch.load(f'logs/distilled/{task}_train_encodings_{language[:2]}.pt')
+    encodings_dev = torch.load(f'logs/distilled/{task}_dev_encodings_{language[:2]}.pt')
 
   if 'h' in rep:
     phanded_train = f'logs/handcrafted/{task}_train_{language[:2].lower()}.json'
     phanded_dev = f'logs/handcrafted/{task}_dev_{language[:2].lower()}.json'
      
-  _, _, labels_train, handed_train = load_Profiling_Data(f'{data_path}/train/{language.lower()}', labeled=True, w_features = phanded_train )
-  _, _, labels_dev, handed_dev = load_Profiling_Data(f'{data_path}/dev/{language.lower()}', labeled=True, w_features = phanded_dev )
-
-  model.load(f'logs/{mod_name}_{language[:2]}_{rep}.pt')
+  _, _, labels_train, handed_train = load_Profiling_Data(f'{data_path}/train/{language.lower()}', labeled=True, w_features = phanded_train, with_tweets = False )
+  _, _, labels_dev, handed_dev = load_Profiling_Data(f'{data_path}/dev/{language.lower()}', labeled=True, w_features = phanded_dev, with_tweets = False )
 
+  start = time.perf_counter()
+  model = load_model(f'{mod_name}_{language[:2]}_{rep}', make, f'logs/{mod_name}_{language[:2]}_{rep}.pt')
   encs = model.get_encodings([encodings_train, handed_train], rep)
+  print(f'{bcolors.OKCYAN}Time to first encoding: {time.perf_counter() - start:.2f}s{bcolors.ENDC}')
   torch.save(np.array(encs), f'logs/modelings/train_{task}_{mod_name}_{language[:2]}.pt')
   
   encs = model.get_encodings( [encodings_dev, handed_dev], rep)
   torch.save(np.array(encs), f'logs/modelings/test_{task}_{mod_name}_{language[:2]}.pt')
   print(f"{bcolors.OKCYAN}{bcolors.BOLD}Encodings Saved Successfully{bcolors.ENDC}")
 
+def encoder_parity(model_name, precision, batch_size=200):
+
+  '''
+    Compare the Encoder at the given precision against fp32 on the train and dev splits under data_path: cosine
+    similarity of the tweet encodings and accuracy of the LSTM classifier and the Impostor method fed with each.
+    Both run on CPU so their throughput is comparable.
+  '''
+  if precision == 'fp32':
+    print( f"{bcolors.FAIL}{bcolors.BOLD}ERROR: Parity needs a reduced precision (int8 or bf16) to compare against fp32{bcolors.ENDC}")
+    exit(1)
+
+  models = {}
+  for name in ['fp32', precision]:
+    models[name] = Encoder(interm_layer_size, max_length, language, mode_weigth)
+    models[name].load(f'{model_name}.pt')
+    if language[-1] == '_':
+      models[name].transformer.load_adapter("logs/hate_adpt_{}".format(language[:2].lower()))
+  models['fp32'].set_precision('fp32')
+  models[precision].set_precision(precision)
+  if models[precision].precision != precision:
+    print( f"{bcolors.FAIL}{bcolors.BOLD}ERROR: {precision} is not available here, no comparison done{bcolors.ENDC}")
+    exit(1)
+
+  encodings, flat, labels = {}, {}, {}
+  for split in ['train', 'dev']:
+    corpus = load_corpus_cache(os.path.join(data_path, split, language[:2].lower()))
+    labels[split] = corpus.labels
+    for name, model in models.items():
+      start = time.perf_counter()
+      e, _ = model.get_encodings(corpus.tweets(), batch_size)
+      print(f'{split} {name}: {len(e)/(time.perf_counter() - start):.1f} tweets/s')
+      flat[name] = e
+      encodings[(split, name)] = group_by_author(e, corpus.author_offsets)
+
+    a, b = flat['fp32'], flat[precision]
+    cosine = (a*b).sum(-1)/np.maximum(np.linalg.norm(a, axis=-1)*np.linalg.norm(b, axis=-1), 1e-12)
+    print(f'{bcolors.OKCYAN}{split} cosine similarity fp32 vs {precision}: mean {cosine.mean():.5f} min {cosine.min():.5f}{bcolors.ENDC}')
+
+  lstm_path = f'logs/lstm_{language[:2]}_t.pt'
+  if os.path.isfile(lstm_path) == False:
+    print(f'{bcolors.WARNING}Warning: {lstm_path} not found, skipping downstream accuracy{bcolors.ENDC}')
+    return
+
+  lstm = LSTMAtt_Classifier(interm_layer_size, 32, lstm_hidden_size, language)
+  lstm.load(lstm_path)
+  acc = {}
+  for name in models:
+    train, dev = [lstm.get_encodings([encodings[(split, name)], None], 't') for split in ['train', 'dev']]
+    with torch.no_grad():
+      y_lstm = torch.max(lstm.clasifier(torch.tensor(dev).to(lstm.device)), 1).indices.cpu().numpy()
+    np.random.seed(0)
+    y_imp = K_Impostor(train[labels['train'] == 1], train[labels['train'] == 0], dev, checkp=coef, method=(metric if metric != 'deepmetric' else 'cosine'))
+    acc[name] = (accuracy_score(labels['dev'], y_lstm), accuracy_score(labels['dev'], y_imp))
+    print(f'{name}: LSTM accuracy {acc[name][0]:.4f} Impostor accuracy {acc[name][1]:.4f}')
+
+  print(f'{bcolors.OKCYAN}Accuracy delta {precision} - fp32: LSTM {acc[precision][0] - acc["fp32"][0]:+.4f} Impostor {acc[precision][1] - acc["fp32"][1]:+.4f}{bcolors.ENDC}')
 
 if __name__ == '__main__':
 
@@ -109,6 +198,23 @@ if __name__ == '__main__':
   up = parameters.up
   task = parameters.task
   rep = parameters.rep 
+  vocab = parameters.vocab
+  encode_by = parameters.encode_by
+  enc_cache = parameters.enc_cache
+  enc_cache_size = parameters.enc_cache_size
+  precision = parameters.precision
+  backend = parameters.backend
+  threads = parameters.threads
+  amp = parameters.amp
+  accumulation = parameters.accumulation
+  checkpoint_steps = parameters.ckpt_steps
+  frozen = parameters.frozen
+  registry = parameters.registry
+  pack = parameters.pack
+  teacher_path = parameters.teacher
+  distilled = parameters.distilled
+  exit_layers = [int(i) for i in parameters.exits.split(',')] if parameters.exits is not None else None
+  exit_threshold = parameters.exit_threshold
 
   if mode == 'encoder':
 
@@ -122,7 +228,7 @@ if __name__ == '__main__':
         os.system(f'mkdir {prefix_path}')
       labels, tweets_word, = read_data(os.path.join(data_path, language.lower()), trans=True)
       
-      history = train_Encoder(model_name, data_path, language, mode_weigth, [tweets_word, labels], splits, epoches, batch_size, max_length, interm_layer_size, learning_rate, decay, 1, 0.1)
+      history = train_Encoder(model_name, data_path, language, mode_weigth, [tweets_word, labels], splits, epoches, batch_size, max_length, interm_layer_size, learning_rate, decay, 1, 0.1, amp, accumulation, checkpoint_steps, frozen, exit_layers)
       plot_training(history[-1], model_name, 'acc')
       plot_training(history[-1], model_name)
     
@@ -137,24 +243,104 @@ if __name__ == '__main__':
         print( f"{bcolors.FAIL}{bcolors.BOLD}ERROR: Weight path set unproperly{bcolors.ENDC}")
         exit(1)
 
-      model = Encoder(interm_layer_size, max_length, language, mode_weigth)
-      model.load(f'{model_name}.pt')
-      if language[-1] == '_':
-        model.transformer.load_adapter("logs/hate_adpt_{}".format(language[:2].lower()))
+      start = time.perf_counter()
+      if backend == 'onnx':
+        if os.path.isfile(f'{model_name}.onnx') == False:
+          print( f"{bcolors.FAIL}{bcolors.BOLD}ERROR: No ONNX graph found, run the export phase first{bcolors.ENDC}")
+          exit(1)
+        model = OnnxEncoder(f'{model_name}.onnx', threads)
+      else:
+        weights = f'{model_name}_exits.pt' if exit_threshold is not None and os.path.isfile(f'{model_name}_exits.pt') else f'{model_name}.pt'
+        model = load_model(os.path.splitext(os.path.basename(weights))[0], lambda: Encoder(interm_layer_size, max_length, language, mode_weigth), weights)
+        if language[-1] == '_':
+          model.transformer.load_adapter("logs/hate_adpt_{}".format(language[:2].lower()))
+        if precision != 'fp32':
+          model.set_precision(precision)
       
-      tweets, _ = load_Profiling_Data(os.path.join(data_path, language[:2].lower()), False)
       preds = []
       encs = []
       batch_size = 200
-      for i in tweets:
-        e, _ = model.get_encodings(i, batch_size)
-        encs.append(e)
-        # preds.append(l)
+      cache = EncodingCache(enc_cache, enc_cache_size) if enc_cache is not None and backend == 'torch' else None
+      if enc_cache is not None and backend == 'onnx':
+        print(f'{bcolors.WARNING}Warning: The encoding cache is only used with the torch backend{bcolors.ENDC}')
+      options = {'cache': cache}
+      if pack is not None and backend == 'torch':
+        options['pack_length'] = pack
+        batch_size = max(1, batch_size*max_length//pack)
+      elif pack is not None:
+        print(f'{bcolors.WARNING}Warning: Packing is only used with the torch backend{bcolors.ENDC}')
+      if exit_threshold is not None and backend == 'torch':
+        options['threshold'] = exit_threshold
+      elif exit_threshold is not None:
+        print(f'{bcolors.WARNING}Warning: Early exit is only used with the torch backend{bcolors.ENDC}')
+      print(f'{bcolors.OKCYAN}Model ready in {time.perf_counter() - start:.2f}s{bcolors.ENDC}')
+      if encode_by == 'corpus':
+        corpus = load_corpus_cache(os.path.join(data_path, language[:2].lower()))
+        e, _ = model.get_encodings(corpus.tweets(), batch_size, **options)
+        print(f'{bcolors.OKCYAN}Time to first encoding: {time.perf_counter() - start:.2f}s{bcolors.ENDC}')
+        encs = group_by_author(e, corpus.author_offsets)
+      else:
+        for _, i, _ in iter_Profiling_Data(os.path.join(data_path, language[:2].lower()), False):
+          e, _ = model.get_encodings(i, batch_size, **options)
+          if len(encs) == 0:
+            print(f'{bcolors.OKCYAN}Time to first encoding: {time.perf_counter() - start:.2f}s{bcolors.ENDC}')
+          encs.append(e)
+          # preds.append(l)
+      if cache is not None:
+        cache.report()
       infosave = data_path.split("/")[-2:]
       torch.save(np.array(encs), f'{prefix_path}/{infosave[0]}_{infosave[1]}_encodings_{language[:2]}.pt')
       # torch.save(np.array(preds),f'logs/{}_pred_{}.pt'.format(phase, language[:2]))
       print(f"{bcolors.OKCYAN}{bcolors.BOLD}Encodings Saved Successfully{bcolors.ENDC}")
 
+    elif phase == 'export':
+
+      '''
+        Export the Encoder to ONNX for the onnx backend of the encode phase
+      '''
+      if os.path.isfile(f'{model_name}.pt') == False:
+        print( f"{bcolors.FAIL}{bcolors.BOLD}ERROR: Weight path set unproperly{bcolors.ENDC}")
+        exit(1)
+      model = Encoder(interm_layer_size, max_length, language, mode_weigth)
+      model.load(f'{model_name}.pt')
+      model.export_onnx(f'{model_name}.onnx')
+      print(f"{bcolors.OKCYAN}{bcolors.BOLD}ONNX Graph Saved Successfully{bcolors.ENDC}")
+
+    elif phase == 'exits':
+
+      '''
+        Train exit heads post hoc on the trained Encoder (unless it already has them) and report the layer exit
+        histogram, speedup and accuracy per threshold on -dt, or on 10% of the tweets held out from that training
+      '''
+      if os.path.isfile(f'{model_name}.pt') == False:
+        print( f"{bcolors.FAIL}{bcolors.BOLD}ERROR: Weight path set unproperly{bcolors.ENDC}")
+        exit(1)
+      model = load_model(os.path.basename(model_name), lambda: Encoder(interm_layer_size, max_length, language, mode_weigth), f'{model_name}.pt')
+      labels, tweets = read_data(os.path.join(data_path, language.lower()), trans=True)
+      held = len(labels)//10
+
+      if model.exits is None:
+        model.add_exits(exit_layers if exit_layers is not None else [3, 6, 9])
+        train_Exits(model, tweets[held:], labels[held:], epoches, batch_size, learning_rate)
+        model.save(f'{model_name}_exits.pt')
+        print(f"{bcolors.OKCYAN}{bcolors.BOLD}Exit Heads Saved Successfully{bcolors.ENDC}")
+
+      if test_path is not None:
+        corpus = load_corpus_cache(os.path.join(test_path, language[:2].lower()))
+        tweets, labels = corpus.tweets(), corpus.tweet_labels()
+      else: tweets, labels = tweets[:held], labels[:held]
+      early_exit_report(model, tweets, labels, [0.7, 0.8, 0.9, 0.95, 0.99])
+
+    elif phase == 'parity':
+
+      '''
+        Check the reduced precision Encoder against fp32, data_path holds the train and dev splits
+      '''
+      if os.path.isfile(f'{model_name}.pt') == False:
+        print( f"{bcolors.FAIL}{bcolors.BOLD}ERROR: Weight path set unproperly{bcolors.ENDC}")
+        exit(1)
+      encoder_parity(model_name, precision)
+
   if mode == 'CNN_LSTM_Encoder' :
 
     language = language.lower()
@@ -163,37 +349,85 @@ if __name__ == '__main__':
       emb_path = 'data/embeddings/glove_en_100d'
     elif language == "es": emb_path = 'data/embeddings/glove_es_200d'
     
-    matrix, dic = read_embedding(emb_path)
+    matrix, dic = load_embedding(emb_path)
    
 
     if phase == 'train':
       model_name = f'CNN_LSTM_ENC_{task}_{learning_rate}'
       # data_path = "../data/profiling/faker/train"
-      model = SeqEncoder(language, matrix)
+      if vocab == 'full':
+        model = SeqEncoder(language, matrix)
       labels, tweets_word, tweets_char, _, _, _ = read_data(os.path.join(data_path, language), dic)
+      if vocab == 'corpus':
+        matrix, dic, remap = restrict_embedding(matrix, dic, [tweets_word])
+        tweets_word = remap[tweets_word]
+        model = SeqEncoder(language, matrix, vocab=dic)
       
       hist = train_Seq(model, [tweets_word, tweets_char, labels], language, model_name, splits, epoches, batch_size, lr = learning_rate,  decay=decay)
       plot_training(hist[-1], f'logs/{model_name}_{language}', 'acc')
       plot_training(hist[-1], f'logs/{model_name}_{language}')
     
-    if phase == 'encode':
-      model_name = f'CNN_LSTM_ENC_{task}'
-      model = SeqEncoder(language, matrix)
+    if phase == 'distill':
+
+      '''
+        Train the SeqEncoder on the intermediate encodings and logits of the transformer Encoder, cached per tweet
+      '''
+      if teacher_path is None:
+        teacher_path = f'/content/drive/MyDrive/Profiling/logs/encoder_trans_{task}_{language.upper()}.pt'
+      if os.path.isfile(teacher_path) == False:
+        print( f"{bcolors.FAIL}{bcolors.BOLD}ERROR: Teacher weights not found at {teacher_path}{bcolors.ENDC}")
+        exit(1)
+
+      model_name = f'CNN_LSTM_DIST_{task}'
+      split_path = os.path.join(data_path, language)
+      teacher = load_model(os.path.splitext(os.path.basename(teacher_path))[0], lambda: Encoder(interm_layer_size, max_length, language.upper(), mode_weigth), teacher_path)
+      teacher_enc, teacher_logits = cache_teacher(teacher, split_path)
+
+      tokens = load_token_cache(split_path, dic, 120, 200)
+      tweets_word = tokens['words']
+      if vocab == 'corpus':
+        matrix, dic, remap = restrict_embedding(matrix, dic, [tweets_word])
+        tweets_word = remap[tweets_word]
+      model = SeqEncoder(language, matrix, vocab=(dic if vocab == 'corpus' else None))
+
+      hist = train_Distill(model, [tweets_word, tokens['chars'], tokens['labels'], teacher_enc, teacher_logits], language, model_name, splits, epoches, batch_size, lr = learning_rate,  decay=decay)
+      plot_training(hist[-1], f'logs/{model_name}_{language}', 'acc')
+      plot_training(hist[-1], f'logs/{model_name}_{language}')
+
       model.load(f'logs/{model_name}_{language}_1.pt')
+      sample = min(2000, len(tweets_word))
+      start = time.perf_counter()
+      teacher.get_encodings(load_corpus_cache(split_path).tweets()[:sample], 200)
+      teacher_speed = sample/(time.perf_counter() - start)
+      start = time.perf_counter()
+      model.get_encodings([np.array(tweets_word[:sample]), np.array(tokens['chars'][:sample])], 200)
+      student_speed = sample/(time.perf_counter() - start)
+      print(f'{bcolors.OKCYAN}Throughput on {sample} tweets: teacher {teacher_speed:.1f} tweets/s student {student_speed:.1f} tweets/s ({student_speed/teacher_speed:.1f}x){bcolors.ENDC}')
+
+    if phase == 'encode':
+      model_name = f'CNN_LSTM_ENC_{task}' if distilled == False else f'CNN_LSTM_DIST_{task}'
+      restricted = load_vocab(f'logs/{model_name}_{language}_1.pt')
+      if restricted is not None:
+        dic = restricted
+        matrix = np.zeros((len(dic) + 1, matrix.shape[1]), dtype=np.float32)
+      start = time.perf_counter()
+      model = load_model(f'{model_name}_{language}_1', lambda: SeqEncoder(language, matrix, vocab=restricted), f'logs/{model_name}_{language}_1.pt')
+      print(f'{bcolors.OKCYAN}Model ready in {time.perf_counter() - start:.2f}s{bcolors.ENDC}')
 
-      tweets, _ = load_Profiling_Data(os.path.join(data_path, language[:2].lower()), False)
       encs = []
-      dicc = {' ': 0}
-      for i in range(26):
-          dicc[chr(i + 97)] = i + 1
-      dicc['\''] = 27
-
-      for i in tweets:
-        tw, _, _ = translate_words(i, dic, 120)
-        tc, _ = translate_char(i, dicc, 200)
+      tokens = load_token_cache(os.path.join(data_path, language[:2].lower()), dic, 120, 200, char_source='raw')
+      offsets = tokens['author_offsets']
+      for i in range(len(offsets) - 1):
+        tw = np.array(tokens['words'][offsets[i]:offsets[i+1]])
+        tc = np.array(tokens['chars'][offsets[i]:offsets[i+1]])
         e = model.get_encodings([tw, tc], 200)
+        if len(encs) == 0:
+          print(f'{bcolors.OKCYAN}Time to first encoding: {time.perf_counter() - start:.2f}s{bcolors.ENDC}')
         encs.append(e)
       infosave = data_path.split("/")[-2:]
+      if distilled == True:
+        os.makedirs('logs/distilled', exist_ok=True)
+        infosave[0] = f'distilled/{infosave[0]}'
       torch.save(np.array(encs), f'logs/{infosave[0]}_{infosave[1]}_encodings_{language[:2].upper()}.pt')
       
       print(f"{bcolors.OKCYAN}{bcolors.BOLD}Encodings Saved Successfully as {infosave[0]}_{infosave[1]}_encodings_{language[:2]}.pt {bcolors.ENDC}")
@@ -219,13 +453,16 @@ if __name__ == '__main__':
       elif 'c' in rep:
         encodings_train = torch.load(f'logs/cnn_lstm/{task}_train_encodings_{language[:2]}.pt')
         encodings_dev = torch.load(f'logs/cnn_lstm/{task}_dev_encodings_{language[:2]}.pt')
+      elif 'd' in rep:
+        encodings_train = torch.load(f'logs/distilled/{task}_train_encodings_{language[:2]}.pt')
+        encodings_dev = torch.load(f'logs/distilled/{task}_dev_encodings_{language[:2]}.pt')
 
       if 'h' in rep:
         phanded_train = f'logs/handcrafted/{task}_train_{language[:2].lower()}.json'
         phanded_dev = f'logs/handcrafted/{task}_dev_{language[:2].lower()}.json'
 
-      _, _, labels_train, handed_train = load_Profiling_Data(f'{data_path}/train/{language.lower()}', labeled=True, w_features = phanded_train )
-      _, _, labels_dev, handed_dev = load_Profiling_Data(f'{data_path}/dev/{language.lower()}', labeled=True, w_features = phanded_dev )
+      _, _, labels_train, handed_train = load_Profiling_Data(f'{data_path}/train/{language.lower()}', labeled=True, w_features = phanded_train, with_tweets = False )
+      _, _, labels_dev, handed_dev = load_Profiling_Data(f'{data_path}/dev/{language.lower()}', labeled=True, w_features = phanded_dev, with_tweets = False )
 
       history = train_classifier(task, rep, 'lstm', data_train = [encodings_train, labels_train], data_dev = [encodings_dev, labels_dev], 
                                   language = language, hfeaat={'train':handed_train, 'dev':handed_dev},splits = splits, epoches= epoches, batch_size = batch_size, 
@@ -235,8 +472,7 @@ if __name__ == '__main__':
       plot_training(history[-1], f'logs/LSTM_{task}_{language}_{learning_rate}')
 
     elif phase == 'encode':
-      model = LSTMAtt_Classifier(interm_layer_size, 32, lstm_hidden_size, language, ('h' in rep))
-      get_encodings(model, 'lstm')
+      get_encodings(lambda: LSTMAtt_Classifier(interm_layer_size, 32, lstm_hidden_size, language, ('h' in rep)), 'lstm')
 
     exit(0)
 
@@ -263,13 +499,16 @@ if __name__ == '__main__':
       elif 'c' in rep:
         encodings_train = torch.load(f'logs/cnn_lstm/{task}_train_encodings_{language[:2]}.pt')
         encodings_dev = torch.load(f'logs/cnn_lstm/{task}_dev_encodings_{language[:2]}.pt')
+      elif 'd' in rep:
+        encodings_train = torch.load(f'logs/distilled/{task}_train_encodings_{language[:2]}.pt')
+        encodings_dev = torch.load(f'logs/distilled/{task}_dev_encodings_{language[:2]}.pt')
 
       # if 'h' in rep:
       phanded_train = f'logs/handcrafted/{task}_train_{language[:2].lower()}.json'
       phanded_dev = f'logs/handcrafted/{task}_dev_{language[:2].lower()}.json'
 
-      _, _, labels_train, handed_train = load_Profiling_Data(f'{data_path}/train/{language.lower()}', labeled=True, w_features = phanded_train )
-      _, _, labels_dev, handed_dev = load_Profiling_Data(f'{data_path}/dev/{language.lower()}', labeled=True, w_features = phanded_dev )
+      _, _, labels_train, handed_train = load_Profiling_Data(f'{data_path}/train/{language.lower()}', labeled=True, w_features = phanded_train, with_tweets = False )
+      _, _, labels_dev, handed_dev = load_Profiling_Data(f'{data_path}/dev/{language.lower()}', labeled=True, w_features = phanded_dev, with_tweets = False )
 
       history = train_GCNN(rep, task, [encodings_train, handed_train, labels_train], [encodings_dev, handed_dev, labels_dev], language, splits = splits, epoches = epoches, batch_size = batch_size, hidden_channels = interm_layer_size, lr=learning_rate, decay=decay)
       plot_training(history[-1], f'logs/GNN_{task}_{language}_{learning_rate}', 'acc')
@@ -277,8 +516,7 @@ if __name__ == '__main__':
     
     elif phase == 'encode':
       
-      model = GCN(language, interm_layer_size, 64, handed_features = ('h' in rep))
-      get_encodings(model, 'gcn')
+      get_encodings(lambda: GCN(language, interm_layer_size, 64, handed_features = ('h' in rep)), 'gcn')
     exit(0)
     
   if mode == 'Impostor':
@@ -290,8 +528,8 @@ if __name__ == '__main__':
     encodings_train = torch.load(f'logs/modelings/train_{task}_{rep}_{language[:2]}.pt')
     encodings_dev = torch.load(f'logs/modelings/test_{task}_{rep}_{language[:2]}.pt')
   
-    _, _, labels_train, _ = load_Profiling_Data(f'{data_path}/train/{language.lower()}', labeled=True, w_features = None )
-    _, _, labels_dev, _ = load_Profiling_Data(f'{data_path}/dev/{language.lower()}', labeled=True, w_features = None )
+    _, _, labels_train, _ = load_Profiling_Data(f'{data_path}/train/{language.lower()}', labeled=True, w_features = None, with_tweets = False )
+    _, _, labels_dev, _ = load_Profiling_Data(f'{data_path}/dev/{language.lower()}', labeled=True, w_features = None, with_tweets = False )
 
     print('*'*50)
     print(f'   coef:{coef}  Encoder:{rep} Language: {language}')
@@ -4,12 +4,13 @@ sys.path.append('../')
 import torch_geometric
 from sklearn.model_selection import StratifiedKFold
 from utils import bcolors
-from models.models import seed_worker
+from models.models import seed_worker, run_inference
 
 class GCN(torch.nn.Module):
 
   def __init__(self, language, hidden_channels=64, features_nodes=96, handed_features = False):
     super(GCN, self).__init__()
+    self.init_args = {'language': language, 'hidden_channels': hidden_channels, 'features_nodes': features_nodes, 'handed_features': handed_features}
 
     self.conv1 = torch_geometric.nn.GCNConv(features_nodes, hidden_channels)
     self.conv2 = torch_geometric.nn.GCNConv(hidden_channels, hidden_channels)
@@ -55,7 +56,7 @@ class GCN(torch.nn.Module):
   def save(self, path):
     torch.save(self.state_dict(), path)
 
-  def get_encodings(self, encodings, rep):
+  def get_encodings(self, encodings, rep, out_path=None):
 
     self.eval() 
     if 'h' in rep:
@@ -74,19 +75,9 @@ class GCN(torch.nn.Module):
     
     data_test = [torch_geometric.data.Data(x=encodings[i], y = features[i], edge_index=edges) for i in range(encodings.shape[0])]
     devloader = torch_geometric.data.DataLoader(data_test, batch_size=64, shuffle=False, num_workers=4, worker_init_fn=seed_worker)
-		
-
-    with torch.no_grad():
-      out = None
-      for k, data in enumerate(devloader, 0):
-        torch.cuda.empty_cache() 
-        dev_out = self.forward(data.x, data.edge_index, data.batch, phase='encode', F = (data.y if 'h' in rep else None))
-        if k == 0:
-          out = dev_out
-        else: 
-          out = torch.cat((out, dev_out), 0)
 
-    out = out.cpu().numpy()
+    step = lambda data: self.forward(data.x, data.edge_index, data.batch, phase='encode', F = (data.y if 'h' in rep else None))
+    out = run_inference(devloader, step, len(data_test), out_path=out_path)
     del devloader
     return out
 
@@ -1,8 +1,8 @@
 #%%
 from sklearn import model_selection
-import torch, os, sys
+import torch, os, sys, json
 sys.path.append('../')
-from models.models import seed_worker
+from models.models import seed_worker, run_inference
 import numpy as np, pandas as pd
 from models.classifiers import AttentionLSTM
 from torch.utils.data import Dataset, DataLoader, dataloader
@@ -10,35 +10,73 @@ from sklearn.model_selection import StratifiedKFold
 from utils import bcolors
 
 
+def load_vocab(path):
+
+  '''
+    Corpus-restricted vocabulary saved by SeqEncoder.save next to the weights at path, None when the
+    model was trained on the full embedding vocabulary.
+  '''
+  path = os.path.splitext(path)[0] + '.vocab'
+  if os.path.isfile(path) == False:
+    return None
+  with open(path) as file:
+    return json.load(file)
+
 class CW_Data(Dataset):
 
-  def __init__(self, data):
+  '''
+    View over the full id matrices restricted to index (e.g. one fold), so folds never copy the corpus.
+    Ids are stored narrow (int32 words, uint8 chars) and widened per example for the embeddings.
+  '''
+  def __init__(self, data, index=None):
 
     self.wordl = data[0] 
     self.charl = data[1] 
     self.label = data[2]
+    self.index = np.arange(self.wordl.shape[0]) if index is None else index
 
   def __len__(self):
-    return self.wordl.shape[0]
+    return len(self.index)
 
   def __getitem__(self, idx):
     if torch.is_tensor(idx):
       idx = idx.tolist()
 
-    tweetword = self.wordl[idx] 
-    tweetchar = self.charl[idx] 
+    idx = self.index[idx]
+    tweetword = self.wordl[idx].astype(np.int64)
+    tweetchar = self.charl[idx].astype(np.int64)
     label = self.label[idx]
 
     sample = {'word': tweetword, 'char':tweetchar, 'label':label}
     return sample
 
+class DistillData(CW_Data):
+
+  '''
+    CW_Data plus the cached teacher outputs of every tweet, data[3] its intermediate encodings and data[4] its logits.
+  '''
+  def __init__(self, data, index=None):
+    super(DistillData, self).__init__(data, index)
+    self.encoding = data[3]
+    self.logits = data[4]
+
+  def __getitem__(self, idx):
+    if torch.is_tensor(idx):
+      idx = idx.tolist()
+
+    sample = super(DistillData, self).__getitem__(idx)
+    idx = self.index[idx]
+    sample['encoding'] = np.asarray(self.encoding[idx], dtype=np.float32)
+    sample['logits'] = np.asarray(self.logits[idx], dtype=np.float32)
+    return sample
+
 class CNN_LSTM(torch.nn.Module):
 
   def __init__(self, embedding_matrix, fix_emb, lstm_layer=64):
 
     super(CNN_LSTM, self).__init__()
     self.emb = torch.nn.Embedding(embedding_matrix.shape[0], embedding_matrix.shape[1])
-    self.emb.load_state_dict({'weight': torch.from_numpy(embedding_matrix)})
+    self.emb.load_state_dict({'weight': torch.tensor(np.asarray(embedding_matrix), dtype=torch.float)})
     if fix_emb:
       self.emb.weight.requires_grad = False
     else: self.emb.weight.requires_grad = True
@@ -80,10 +118,12 @@ class CNN_LSTM(torch.nn.Module):
 
 class SeqEncoder(torch.nn.Module):
 
-  def __init__(self, language, embedding_matrix_word, lstm_layer=64):
+  def __init__(self, language, embedding_matrix_word, lstm_layer=64, vocab=None):
 
     super(SeqEncoder, self).__init__()
+    self.init_args = {'language': language, 'embedding_shape': list(embedding_matrix_word.shape), 'lstm_layer': lstm_layer, 'vocab': vocab}
     self.lang = language
+    self.vocab = vocab
     self.best_acc = None
     self.best_acc_train = None
     self.Word_EncMod = CNN_LSTM(embedding_matrix_word, True, 64)
@@ -116,28 +156,18 @@ class SeqEncoder(torch.nn.Module):
     if os.path.exists('./logs') == False:
         os.system('mkdir logs')
     torch.save(self.state_dict(), os.path.join('logs', path))
+    if self.vocab is not None:
+      with open(os.path.join('logs', os.path.splitext(path)[0] + '.vocab'), 'w') as file:
+        json.dump(self.vocab, file)
 
 
-  def get_encodings(self, data, batch_size):
+  def get_encodings(self, data, batch_size, out_path=None):
 
     self.eval()    
     data.append(np.zeros((len(data[0]),)))
     devloader = DataLoader(CW_Data(data), batch_size=batch_size, shuffle=False, num_workers=4)
  
-    with torch.no_grad():
-      out = None
-      log = None
-      for k, data in enumerate(devloader, 0):
-        torch.cuda.empty_cache() 
-        inputsw, inputsc = data['word'], data['char']
-
-        dev_encode = self.forward(inputsw, inputsc, False)
-        if k == 0:
-          out = dev_encode
-        else: 
-          out = torch.cat((out, dev_encode), 0)
-
-    out = out.cpu().numpy()
+    out = run_inference(devloader, lambda batch: self.forward(batch['word'], batch['char'], False), len(data[0]), out_path=out_path)
     del devloader
     return out
 
@@ -153,8 +183,8 @@ def train_Seq(model, data, language, model_name, splits = 5, epoches = 4, batch_
     
     history.append({'loss': [], 'acc':[], 'dev_loss': [], 'dev_acc': []})
     optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=decay)
-    trainloader = DataLoader(CW_Data([data[0][train_index], data[1][train_index], data[2][train_index]]), batch_size=batch_size, shuffle=True, num_workers=4, worker_init_fn=seed_worker)
-    devloader = DataLoader(CW_Data([data[0][test_index], data[1][test_index], data[2][test_index]]), batch_size=batch_size, shuffle=True, num_workers=4, worker_init_fn=seed_worker)
+    trainloader = DataLoader(CW_Data(data, train_index), batch_size=batch_size, shuffle=True, num_workers=4, worker_init_fn=seed_worker)
+    devloader = DataLoader(CW_Data(data, test_index), batch_size=batch_size, shuffle=True, num_workers=4, worker_init_fn=seed_worker)
     batches = len(trainloader)
 
     for epoch in range(epoches):
@@ -241,11 +271,102 @@ def train_Seq(model, data, language, model_name, splits = 5, epoches = 4, batch_
   print(f"{bcolors.OKGREEN}{bcolors.BOLD}{50*'*'}\nOveral Accuracy {model_name} {language} in {spl} slpits: {overall_acc/spl}\n{50*'*'}{bcolors.ENDC}")
   return history
 
+def distillation_loss(encoding, logits, target_encoding, target_logits, temperature=2.0):
 
+  '''
+    Regression of the teacher intermediate encodings plus the temperature softened KL divergence to its logits.
+  '''
+  regression = torch.nn.functional.mse_loss(encoding, target_encoding)
+  soft = torch.nn.functional.kl_div(torch.nn.functional.log_softmax(logits/temperature, dim=-1),
+                                    torch.nn.functional.softmax(target_logits/temperature, dim=-1), reduction='batchmean')
+  return regression + soft*temperature**2
 
+def train_Distill(model, data, language, model_name, splits = 5, epoches = 4, batch_size = 64, lr = 1e-3,  decay=1e-5, temperature=2.0):
 
+  '''
+    Train the SeqEncoder to reproduce the transformer Encoder: data is [words, chars, labels, teacher encodings,
+    teacher logits] per tweet. Weights are kept by dev accuracy against the true labels, as train_Seq does, and
+    the teacher accuracy on the same dev tweets is reported alongside.
+  '''
+  skf = StratifiedKFold(n_splits=splits, shuffle=True, random_state = 23)
+  history = []
 
+  for i, (train_index, test_index) in enumerate(skf.split(np.zeros((len(data[2]), 1)), data[2])):  
+    
+    history.append({'loss': [], 'acc':[], 'dev_loss': [], 'dev_acc': []})
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=decay)
+    trainloader = DataLoader(DistillData(data, train_index), batch_size=batch_size, shuffle=True, num_workers=4, worker_init_fn=seed_worker)
+    devloader = DataLoader(DistillData(data, test_index), batch_size=batch_size, shuffle=True, num_workers=4, worker_init_fn=seed_worker)
+    batches = len(trainloader)
+    teacher_acc = (np.argmax(np.asarray(data[4])[test_index], axis=-1) == np.asarray(data[2])[test_index]).mean()
 
+    for epoch in range(epoches):
 
+      running_loss = 0.0
+      perc = 0
+      acc = 0
+
+      model.train()
+      
+      for j, batch in enumerate(trainloader, 0):
+
+        torch.cuda.empty_cache()         
+        labels = batch['label'].to(model.device)
+        
+        optimizer.zero_grad()
+        encoding = model(batch['word'], batch['char'], False)
+        outputs = model.classifier(encoding)
+        loss = distillation_loss(encoding, outputs, batch['encoding'].to(model.device), batch['logits'].to(model.device), temperature)
 
+        loss.backward()
+        optimizer.step()
 
+        # print statistics
+        with torch.no_grad():
+          if j == 0:
+            acc = ((1.0*(torch.max(outputs, 1).indices == labels)).sum()/len(labels)).cpu().numpy()
+            running_loss = loss.item()
+          else: 
+            acc = (acc + ((1.0*(torch.max(outputs, 1).indices == labels)).sum()/len(labels)).cpu().numpy())/2.0
+            running_loss = (running_loss + loss.item())/2.0
+
+        if (j+1)*100.0/batches - perc  >= 1 or j == batches-1:
+          perc = (1+j)*100.0/batches
+          last_printed = f'\rEpoch:{epoch+1:3d} of {epoches} step {j+1} of {batches}. {perc:.1f}% loss: {running_loss:.3f}'
+          print(last_printed, end="")
+
+      model.eval()
+      history[-1]['loss'].append(running_loss)
+      with torch.no_grad():
+        dev_loss, hits, total = 0.0, 0, 0
+        for batch in devloader:
+          labels = batch['label'].to(model.device)
+          encoding = model(batch['word'], batch['char'], False)
+          outputs = model.classifier(encoding)
+          dev_loss += distillation_loss(encoding, outputs, batch['encoding'].to(model.device), batch['logits'].to(model.device), temperature).item()*len(labels)
+          hits += (torch.max(outputs, 1).indices == labels).sum().item()
+          total += len(labels)
+
+        dev_loss /= total
+        dev_acc = np.array(hits/total)
+        history[-1]['acc'].append(acc)
+        history[-1]['dev_loss'].append(dev_loss)
+        history[-1]['dev_acc'].append(dev_acc) 
+
+        band = False
+        if model.best_acc is None or model.best_acc < dev_acc:
+          model.save(f'{model_name}_{language}_{i+1}.pt')
+          model.best_acc = dev_acc
+          band = True
+
+        ep_finish_print = f' acc: {acc:.3f} | dev_loss: {dev_loss:.3f} dev_acc: {dev_acc.reshape(-1)[0]:.3f} (teacher {teacher_acc:.3f})'
+
+        if band == True:
+            print(bcolors.OKBLUE + bcolors.BOLD + last_printed + ep_finish_print + '\t[Weights Updated]' + bcolors.ENDC)
+        else: print(ep_finish_print)
+                  
+    print(f"{bcolors.OKGREEN}{bcolors.BOLD}{50*'*'}\nDev Accuracy {model_name} {language}: student {model.best_acc:.4f} teacher {teacher_acc:.4f}\n{50*'*'}{bcolors.ENDC}")
+    del trainloader
+    del devloader
+    break
+  return history
@@ -2,7 +2,7 @@
 from numpy.lib.function_base import select
 import torch, os
 from sklearn.metrics import accuracy_score
-from models.models import  Aditive_Attention, seed_worker
+from models.models import  Aditive_Attention, seed_worker, run_inference
 from torch.utils.data import Dataset, DataLoader
 import numpy as np
 from sklearn.metrics.pairwise import euclidean_distances, cosine_similarity
@@ -130,24 +130,12 @@ class FNN_Classifier(torch.nn.Module):
             os.system('mkdir logs')
         torch.save(self.state_dict(), os.path.join('logs', path))
     
-    def get_encodings(self, encodings, batch_size):
+    def get_encodings(self, encodings, batch_size, out_path=None):
 
         self.eval()    
         devloader = DataLoader(encodings, batch_size=batch_size, shuffle=False, num_workers=4, worker_init_fn=seed_worker)
-    
-        with torch.no_grad():
-            out = None
-            log = None
-            for k, data in enumerate(devloader, 0):
-                torch.cuda.empty_cache() 
-
-                dev_out = self.forward(data, encode=True)
-                if k == 0:
-                    out = dev_out
-                else: out = torch.cat((out, dev_out), 0)
-
-            out = out.cpu().numpy()
-            del devloader
+        out = run_inference(devloader, lambda data: self.forward(data, encode=True), len(encodings), out_path=out_path)
+        del devloader
         return out 
 
 
@@ -296,6 +284,7 @@ class LSTMAtt_Classifier(torch.nn.Module):
     def __init__(self, hidden_size, attention_neurons, lstm_size, language='EN', using_features=False):
 
         super(LSTMAtt_Classifier, self).__init__()
+        self.init_args = {'hidden_size': hidden_size, 'attention_neurons': attention_neurons, 'lstm_size': lstm_size, 'language': language, 'using_features': using_features}
 
         self.best_acc = -1
         self.language = language
@@ -349,24 +338,14 @@ class LSTMAtt_Classifier(torch.nn.Module):
             os.system('mkdir logs')
         torch.save(self.state_dict(), os.path.join('logs', path))
 
-    def get_encodings(self, encodings, rep):
+    def get_encodings(self, encodings, rep, out_path=None):
 
       self.eval()    
-      devloader = DataLoader(FNNData([encodings[0], np.zeros_like(encodings[0]), encodings[1]]), batch_size=64, shuffle=True, num_workers=4, worker_init_fn=seed_worker)
-
-      with torch.no_grad():
-          out = None
-          log = None
-          for k, data in enumerate(devloader, 0):
-              torch.cuda.empty_cache() 
-              inputs, features = data['profile'], data['handed_features'] 
-              dev_out = self.forward(inputs, F = (features if 'h' in rep else None), encode = True)
-              if k == 0:
-                  out = dev_out
-              else: out = torch.cat((out, dev_out), 0)
+      devloader = DataLoader(FNNData([encodings[0], np.zeros_like(encodings[0]), encodings[1]]), batch_size=64, shuffle=False, num_workers=4, worker_init_fn=seed_worker)
 
-          out = out.cpu().numpy()
-          del devloader
+      step = lambda data: self.forward(data['profile'], F = (data['handed_features'] if 'h' in rep else None), encode = True)
+      out = run_inference(devloader, step, len(encodings[0]), out_path=out_path)
+      del devloader
       return out 
 
 
@@ -3,28 +3,53 @@ import torch, os, sys
 from transformers.utils.dummy_pt_objects import RetriBertModel
 sys.path.append('../')
 import numpy as np, pandas as pd
-from transformers import AutoTokenizer, AutoModel
-from torch.utils.data import Dataset, DataLoader, dataloader
+from transformers import AutoTokenizer, AutoModel, AutoConfig
+from torch.utils.data import Dataset, DataLoader, dataloader, Sampler
 from sklearn.model_selection import StratifiedKFold
-import random
-from utils import bcolors
+import random, itertools, hashlib, sqlite3, time, contextlib, json, resource
+from utils import bcolors, load_corpus_cache, corpus_fingerprint, TweetArray
 
 
-def HuggTransformer(language, mode_weigth):
+def cpu_bf16_supported():
+
+  '''
+    Whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX), where bf16 autocast pays off.
+  '''
+  if hasattr(torch, 'autocast') == False:
+    return False
+  for check in ('_is_avx512_bf16_supported', '_is_amx_tile_supported'):
+    if getattr(getattr(torch, 'cpu', None), check, lambda: False)():
+      return True
+  return False
+
+def empty_transformer(name):
+
+  '''
+    Architecture of name without reading or initializing its weights, for models whose weights are loaded right after.
+  '''
+  try:
+    from transformers.modeling_utils import no_init_weights
+  except ImportError:
+    no_init_weights = contextlib.nullcontext
+  with no_init_weights():
+    return AutoModel.from_config(AutoConfig.from_pretrained(name))
+
+def HuggTransformer(language, mode_weigth, pretrained=True):
 
   if mode_weigth == 'online': 
     prefix = '' 
   else: prefix = '/home/nitro/projects/PAN/data/'
+  load = AutoModel.from_pretrained if pretrained == True else empty_transformer
   
   if language == "ES":
-    model = AutoModel.from_pretrained(os.path.join(prefix , "dccuchile/bert-base-spanish-wwm-cased"))
+    model = load(os.path.join(prefix , "dccuchile/bert-base-spanish-wwm-cased"))
     tokenizer = AutoTokenizer.from_pretrained(os.path.join(prefix , "dccuchile/bert-base-spanish-wwm-cased"), do_lower_case=False, TOKENIZERS_PARALLELISM=True)
   elif language == "EN":
-    model = AutoModel.from_pretrained(os.path.join(prefix , "vinai/bertweet-base"))
+    model = load(os.path.join(prefix , "vinai/bertweet-base"))
     tokenizer = AutoTokenizer.from_pretrained(os.path.join(prefix , "vinai/bertweet-base"), do_lower_case=False)
   elif language[-1] == "_":
     
-    model = AutoModel.from_pretrained(os.path.join(prefix + "bert-base-multilingual-cased"))
+    model = load(os.path.join(prefix + "bert-base-multilingual-cased"))
     tokenizer = AutoTokenizer.from_pretrained(os.path.join(prefix + "bert-base-multilingual-cased"), do_lower_case=False)
     model.add_adapter(adapter_name='hate_adpt_{}'.format(language[:2].lower()), adapter_type=AdapterType.text_task)
     model.train_adapter(['hate_adpt_{}'.format(language[:2].lower())])
@@ -38,6 +63,37 @@ def seed_worker(worker_id):
     np.random.seed(worker_seed)
     random.seed(worker_seed)
 
+def run_inference(loader, step, size, rows=None, out_path=None):
+
+  '''
+    Shared inference loop of the get_encodings methods. step(batch) returns a tensor or a tuple of tensors;
+    each output gets one (size, ...) array allocated on the first batch (the first one memory-mapped to
+    out_path when given) and every batch is written in place, at rows(batch) when the loader reorders
+    examples or consecutively otherwise. Runs under torch.inference_mode.
+  '''
+  outputs = None
+  position = 0
+  with torch.inference_mode():
+    for batch in loader:
+      values = step(batch)
+      values = [i.cpu().numpy() for i in (values if isinstance(values, tuple) else (values,))]
+
+      if outputs is None:
+        outputs = []
+        for k, i in enumerate(values):
+          if k == 0 and out_path is not None:
+            outputs.append(np.lib.format.open_memmap(out_path, mode='w+', dtype=i.dtype, shape=(size,) + i.shape[1:]))
+          else: outputs.append(np.empty((size,) + i.shape[1:], dtype=i.dtype))
+
+      index = rows(batch) if rows is not None else slice(position, position + len(values[0]))
+      for out, i in zip(outputs, values):
+        out[index] = i
+      position += len(values[0])
+
+  if outputs is None:
+    return None
+  return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
 class RawDataset(Dataset):
   def __init__(self, csv_file, dataframe=False):
     if dataframe == False:
@@ -67,18 +123,20 @@ class RawDataset(Dataset):
 
 class TW_Data(Dataset):
 
-  def __init__(self, data):
+  def __init__(self, data, index=None):
 
     self.wordl = data[0] 
     self.label = data[1]
+    self.index = np.arange(self.wordl.shape[0]) if index is None else index
 
   def __len__(self):
-    return self.wordl.shape[0]
+    return len(self.index)
 
   def __getitem__(self, idx):
     if torch.is_tensor(idx):
       idx = idx.tolist()
 
+    idx = self.index[idx]
     tweetword = self.wordl[idx] 
     label = self.label[idx]
 
@@ -86,6 +144,279 @@ class TW_Data(Dataset):
     return sample
 
 
+def pretokenize(tokenizer, text, max_length, chunk=10000):
+
+  '''
+    Tokenize every tweet once (truncated to max_length, unpadded) into a flat int32 id buffer plus offsets,
+    tweet k being ids[offsets[k]:offsets[k+1]].
+  '''
+  ids = [np.zeros((0,), dtype=np.int32)]
+  lengths = [0]
+  for i in range(0, len(text), chunk):
+    batch = tokenizer([str(t) for t in text[i:i+chunk]], truncation=True, max_length=max_length)['input_ids']
+    ids.append(np.fromiter(itertools.chain.from_iterable(batch), dtype=np.int32))
+    lengths += [len(tweet) for tweet in batch]
+  return np.concatenate(ids), np.cumsum(lengths)
+
+class TokenizedDataset(Dataset):
+
+  def __init__(self, tokens, label=None, index=None):
+
+    self.ids, self.offsets = tokens
+    self.label = label
+    self.index = np.arange(len(self.offsets) - 1) if index is None else index
+
+  def __len__(self):
+    return len(self.index)
+
+  def lengths(self):
+    return (self.offsets[1:] - self.offsets[:-1])[self.index]
+
+  def __getitem__(self, idx):
+    if torch.is_tensor(idx):
+      idx = idx.tolist()
+
+    i = self.index[idx]
+    label = self.label[i] if self.label is not None else 0
+    return {'input_ids': self.ids[self.offsets[i]:self.offsets[i+1]], 'label': label, 'index': idx}
+
+class PadCollate:
+
+  '''
+    Pad a batch of TokenizedDataset examples to its longest tweet only, the way the tokenizer does with padding=True.
+  '''
+  def __init__(self, pad_id):
+    self.pad_id = pad_id
+
+  def __call__(self, batch):
+
+    ids = np.full((len(batch), max(len(i['input_ids']) for i in batch)), self.pad_id, dtype=np.int64)
+    mask = np.zeros_like(ids)
+    for k, i in enumerate(batch):
+      ids[k, :len(i['input_ids'])] = i['input_ids']
+      mask[k, :len(i['input_ids'])] = 1
+
+    return {'tweet': {'input_ids': torch.from_numpy(ids), 'attention_mask': torch.from_numpy(mask)},
+            'label': torch.tensor([i['label'] for i in batch]), 'index': torch.tensor([i['index'] for i in batch])}
+
+class LengthBucketSampler(Sampler):
+
+  '''
+    Batch sampler grouping tweets of similar length so each batch pads to a short maximum. When shuffling,
+    random pools of pool batches are sorted by length, cut into batches, and the batches are shuffled;
+    otherwise the whole set is batched in length order. Setting skip drops that many batches from the
+    start of the next pass only, to resume an epoch with the same random state it started with.
+  '''
+  def __init__(self, lengths, batch_size, shuffle=True, pool=100):
+    self.lengths = np.asarray(lengths)
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.pool = pool
+    self.skip = 0
+
+  def __iter__(self):
+    # A generator, so skip is only taken when iteration starts: DataLoader builds and drops an iterator before using one
+    skip, self.skip = self.skip, 0
+    yield from itertools.islice(self.batches(), skip, None)
+
+  def __len__(self):
+    return (len(self.lengths) + self.batch_size - 1)//self.batch_size
+
+  def batches(self):
+
+    if self.shuffle == False:
+      order = np.argsort(self.lengths, kind='stable')
+      for i in range(0, len(order), self.batch_size):
+        yield list(order[i:i+self.batch_size])
+      return
+
+    order = np.random.permutation(len(self.lengths))
+    batches = []
+    for i in range(0, len(order), self.batch_size*self.pool):
+      chunk = order[i:i+self.batch_size*self.pool]
+      chunk = chunk[np.argsort(self.lengths[chunk], kind='stable')]
+      batches += [list(chunk[j:j+self.batch_size]) for j in range(0, len(chunk), self.batch_size)]
+    for i in np.random.permutation(len(batches)):
+      yield batches[i]
+
+class PackingSampler(Sampler):
+
+  '''
+    Batch sampler for sequence packing: tweets in length order are laid one after another into packs of at most
+    pack_length tokens, a new pack starting when the next tweet does not fit, and batch_size packs make a batch.
+    PackedCollate rebuilds the same packs from the order of the batch.
+  '''
+  def __init__(self, lengths, pack_length, batch_size):
+
+    self.batches = []
+    batch, packs, used = [], 0, pack_length
+    for i in np.argsort(lengths, kind='stable'):
+      if used + lengths[i] > pack_length:
+        if packs == batch_size:
+          self.batches.append(batch)
+          batch, packs = [], 0
+        packs += 1
+        used = 0
+      batch.append(i)
+      used += lengths[i]
+    if len(batch):
+      self.batches.append(batch)
+
+  def __len__(self):
+    return len(self.batches)
+
+  def __iter__(self):
+    return iter(self.batches)
+
+class PackedCollate:
+
+  '''
+    Pack a batch of TokenizedDataset examples several tweets per sequence. Each tweet only attends to itself
+    (block-diagonal attention_mask) and its position ids restart at position_offset, so the transformer sees it
+    as if it were alone; pack and start locate the first token of every tweet in the output.
+  '''
+  def __init__(self, pad_id, pack_length, position_offset=0):
+    self.pad_id = pad_id
+    self.pack_length = pack_length
+    self.position_offset = position_offset
+
+  def __call__(self, batch):
+
+    packs, used = [[]], 0
+    for i in batch:
+      if used + len(i['input_ids']) > self.pack_length:
+        packs.append([])
+        used = 0
+      packs[-1].append(i)
+      used += len(i['input_ids'])
+
+    width = max(sum(len(i['input_ids']) for i in p) for p in packs)
+    ids = np.full((len(packs), width), self.pad_id, dtype=np.int64)
+    mask = np.zeros((len(packs), width, width), dtype=np.int64)
+    positions = np.full((len(packs), width), self.position_offset, dtype=np.int64)
+    pack, start, index = [], [], []
+    for k, p in enumerate(packs):
+      s = 0
+      for i in p:
+        n = len(i['input_ids'])
+        ids[k, s:s+n] = i['input_ids']
+        mask[k, s:s+n, s:s+n] = 1
+        positions[k, s:s+n] = np.arange(n) + self.position_offset
+        pack.append(k)
+        start.append(s)
+        index.append(i['index'])
+        s += n
+
+    return {'tweet': {'input_ids': torch.from_numpy(ids), 'attention_mask': torch.from_numpy(mask), 'position_ids': torch.from_numpy(positions),
+                      'pack': torch.tensor(pack), 'start': torch.tensor(start)},
+            'label': torch.tensor([i['label'] for p in packs for i in p]), 'index': torch.tensor(index)}
+
+def packed_loader(tokenizer, dataset, batch_size, pack_length, position_offset):
+  return DataLoader(dataset, batch_sampler=PackingSampler(dataset.lengths(), pack_length, batch_size), collate_fn=PackedCollate(tokenizer.pad_token_id, pack_length, position_offset), num_workers=4, worker_init_fn=seed_worker, persistent_workers=True)
+
+def tokenized_loader(tokenizer, dataset, batch_size, shuffle):
+  return DataLoader(dataset, batch_sampler=LengthBucketSampler(dataset.lengths(), batch_size, shuffle), collate_fn=PadCollate(tokenizer.pad_token_id), num_workers=4, worker_init_fn=seed_worker, persistent_workers=True)
+
+class FeatureDataset(Dataset):
+
+  '''
+    Examples from a backbone cache (see cache_backbone): one [CLS] state per tweet, or when offsets is given the
+    hidden states of every token of tweet k at features[offsets[k]:offsets[k+1]].
+  '''
+  def __init__(self, features, offsets=None, label=None, index=None):
+
+    self.features = features
+    self.offsets = offsets
+    self.label = label
+    self.index = np.arange(len(features) if offsets is None else len(offsets) - 1) if index is None else index
+
+  def __len__(self):
+    return len(self.index)
+
+  def lengths(self):
+    if self.offsets is None:
+      return np.ones((len(self.index),), dtype=np.int64)
+    return (self.offsets[1:] - self.offsets[:-1])[self.index]
+
+  def __getitem__(self, idx):
+    if torch.is_tensor(idx):
+      idx = idx.tolist()
+
+    i = self.index[idx]
+    label = self.label[i] if self.label is not None else 0
+    features = self.features[i] if self.offsets is None else self.features[self.offsets[i]:self.offsets[i+1]]
+    return {'features': np.asarray(features, dtype=np.float32), 'label': label, 'index': idx}
+
+class FeatureCollate:
+
+  '''
+    Stack [CLS] states, or pad token hidden states to the longest tweet of the batch along with their attention mask.
+  '''
+  def __call__(self, batch):
+
+    label = torch.tensor([i['label'] for i in batch])
+    index = torch.tensor([i['index'] for i in batch])
+    if batch[0]['features'].ndim == 1:
+      return {'tweet': torch.from_numpy(np.stack([i['features'] for i in batch])), 'label': label, 'index': index}
+
+    hidden = np.zeros((len(batch), max(len(i['features']) for i in batch), batch[0]['features'].shape[-1]), dtype=np.float32)
+    mask = np.zeros(hidden.shape[:2], dtype=np.int64)
+    for k, i in enumerate(batch):
+      hidden[k, :len(i['features'])] = i['features']
+      mask[k, :len(i['features'])] = 1
+    return {'tweet': {'hidden': torch.from_numpy(hidden), 'attention_mask': torch.from_numpy(mask)}, 'label': label, 'index': index}
+
+def feature_loader(dataset, batch_size, shuffle):
+  return DataLoader(dataset, batch_sampler=LengthBucketSampler(dataset.lengths(), batch_size, shuffle), collate_fn=FeatureCollate(), num_workers=4, worker_init_fn=seed_worker, persistent_workers=True)
+
+class EncodingCache:
+
+  '''
+    Persistent content-addressed store of tweet encodings (SQLite at path). Entries are keyed by the hash of
+    the tweet text together with Encoder.cache_key(), so they are shared by every author, split and run of the
+    same weights and max_length. Holds at most max_entries rows, evicting the least recently used ones.
+  '''
+  def __init__(self, path, max_entries=5000000):
+
+    if os.path.dirname(path) != '' and os.path.isdir(os.path.dirname(path)) == False:
+      os.makedirs(os.path.dirname(path))
+    self.db = sqlite3.connect(path)
+    self.db.execute('CREATE TABLE IF NOT EXISTS encodings (key BLOB PRIMARY KEY, vec BLOB, last_used INTEGER)')
+    self.db.execute('CREATE INDEX IF NOT EXISTS lru ON encodings (last_used)')
+    self.max_entries = max_entries
+    self.rows = self.db.execute('SELECT COUNT(*) FROM encodings').fetchone()[0]
+    self.hits = 0
+    self.misses = 0
+
+  def keys(self, model_key, text):
+    return [hashlib.sha1(model_key + str(t).encode('utf-8')).digest() for t in text]
+
+  def get(self, keys, chunk=900):
+
+    found = {}
+    for i in range(0, len(keys), chunk):
+      part = keys[i:i+chunk]
+      rows = self.db.execute(f'SELECT key, vec FROM encodings WHERE key IN ({",".join("?"*len(part))})', part).fetchall()
+      for key, vec in rows:
+        found[key] = np.frombuffer(vec, dtype=np.float32)
+
+    self.db.executemany('UPDATE encodings SET last_used = ? WHERE key = ?', [(time.time_ns(), i) for i in found])
+    self.db.commit()
+    return found
+
+  def put(self, keys, vectors):
+
+    now = time.time_ns()
+    self.rows += self.db.executemany('INSERT OR IGNORE INTO encodings VALUES (?, ?, ?)',
+                                     [(key, np.ascontiguousarray(vec, dtype=np.float32).tobytes(), now) for key, vec in zip(keys, vectors)]).rowcount
+    if self.rows > self.max_entries:
+      self.rows -= self.db.execute('DELETE FROM encodings WHERE key IN (SELECT key FROM encodings ORDER BY last_used LIMIT ?)', (self.rows - self.max_entries,)).rowcount
+    self.db.commit()
+
+  def report(self):
+    total = max(1, self.hits + self.misses)
+    print(f'{bcolors.OKCYAN}Encoding cache: {self.hits} hits {self.misses} misses ({100.0*self.hits/total:.1f}% hit rate){bcolors.ENDC}')
+
 class SiameseData(Dataset):
   def __init__(self, data):
 
@@ -108,7 +439,7 @@ class SiameseData(Dataset):
   
 class Encoder(torch.nn.Module):
 
-  def __init__(self, interm_size, max_length, language='EN', mode_weigth='online'):
+  def __init__(self, interm_size, max_length, language='EN', mode_weigth='online', pretrained=True):
 
     if language[-1] == '_':
       global AdapterType
@@ -116,26 +447,35 @@ class Encoder(torch.nn.Module):
 
     super(Encoder, self).__init__()
 		
+    self.init_args = {'interm_size': interm_size, 'max_length': max_length, 'language': language, 'mode_weigth': mode_weigth}
     self.best_acc = None
     self.max_length = max_length
     self.language = language
     self.interm_neurons = interm_size
-    self.transformer, self.tokenizer = HuggTransformer(language, mode_weigth)
+    self.precision = 'fp32'
+    self.frozen = 0
+    self.transformer, self.tokenizer = HuggTransformer(language, mode_weigth, pretrained)
     self.intermediate = torch.nn.Sequential(torch.nn.Dropout(p=0.5), torch.nn.Linear(in_features=768, out_features=self.interm_neurons), torch.nn.LeakyReLU())
     self.classifier = torch.nn.Linear(in_features=self.interm_neurons, out_features=2)
+    self.exits = None
+    self.exit_layers = None
     self.loss_criterion = torch.nn.CrossEntropyLoss()
     self.device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
     self.to(device=self.device)
 
   def forward(self, X, get_encoding=False):
 
-    ids = self.tokenizer(X, return_tensors='pt', truncation=True, padding=True, max_length=self.max_length).to(device=self.device)
+    if isinstance(X, dict):
+      ids = {k: v.to(device=self.device) for k, v in X.items()}
+    else: ids = self.tokenizer(X, return_tensors='pt', truncation=True, padding=True, max_length=self.max_length).to(device=self.device)
 
-    if self.language[-1] == '_':
-      X = self.transformer(**ids, adapter_names=['hate_adpt_{}'.format(self.language[:2])])[0]
-    else: X = self.transformer(**ids)[0]
+    autocast = torch.autocast('cpu', dtype=torch.bfloat16) if self.precision == 'bf16' else contextlib.nullcontext()
+    with autocast:
+      if self.language[-1] == '_':
+        X = self.transformer(**ids, adapter_names=['hate_adpt_{}'.format(self.language[:2])])[0]
+      else: X = self.transformer(**ids)[0]
 
-    X = X[:,0]
+    X = X[:,0].float()
     enc = self.intermediate(X)
     output = self.classifier(enc)
     if get_encoding == True:
@@ -143,12 +483,229 @@ class Encoder(torch.nn.Module):
 
     return output 
 
+  def add_exits(self, layers):
+
+    '''
+      Exit heads after the given transformer layers (1-based). Each maps that layer's [CLS] state to an encoding
+      of the intermediate size, classified by the shared classifier and trained to match the final encoding, so
+      tweets leaving early still give encodings the downstream classifiers understand.
+    '''
+    if self.language[-1] == '_':
+      raise ValueError('Adapter encoders do not support early exits')
+    self.exit_layers = sorted(set(int(l) for l in layers if 0 < int(l) < len(self.transformer.encoder.layer)))
+    self.exits = torch.nn.ModuleDict({str(l): torch.nn.Sequential(torch.nn.Dropout(p=0.5), torch.nn.Linear(in_features=768, out_features=self.interm_neurons), torch.nn.LeakyReLU())
+                                      for l in self.exit_layers})
+    self.exits.to(device=self.device)
+
+  def exit_outputs(self, X):
+
+    '''
+      Final logits and encoding plus the encoding of every exit head, from one pass over all layers.
+    '''
+    if isinstance(X, dict):
+      ids = {k: v.to(device=self.device) for k, v in X.items()}
+    else: ids = self.tokenizer(X, return_tensors='pt', truncation=True, padding=True, max_length=self.max_length).to(device=self.device)
+
+    hidden = self.transformer(**ids, output_hidden_states=True).hidden_states
+    enc = self.intermediate(hidden[-1][:,0])
+    return self.classifier(enc), enc, [self.exits[str(l)](hidden[l][:,0]) for l in self.exit_layers]
+
+  def early_exit_forward(self, X, threshold):
+
+    '''
+      Layer by layer forward where each tweet leaves at the first exit head whose confidence (highest class
+      probability) reaches threshold, the rest of the batch going on alone. Returns encodings, logits and the
+      layer every tweet left at (the last one when no exit was confident enough).
+    '''
+    ids = {k: v.to(device=self.device) for k, v in X.items()}
+    layers = self.transformer.encoder.layer
+    H = self.transformer.embeddings(input_ids=ids['input_ids'])
+    mask = ids['attention_mask']
+    alive = torch.arange(len(H), device=self.device)
+    enc = torch.zeros((len(H), self.interm_neurons), device=self.device)
+    exit_layer = torch.full((len(H),), len(layers), dtype=torch.long, device=self.device)
+
+    for l, layer in enumerate(layers, 1):
+      H = layer(H, attention_mask=self.extended_mask(mask, H.dtype))[0]
+      if l == len(layers):
+        enc[alive] = self.intermediate(H[:,0])
+        break
+      if str(l) not in self.exits:
+        continue
+
+      e = self.exits[str(l)](H[:,0])
+      done = torch.softmax(self.classifier(e), dim=-1).max(dim=-1).values >= threshold
+      enc[alive[done]] = e[done]
+      exit_layer[alive[done]] = l
+      if done.all():
+        break
+      H, mask, alive = H[~done], mask[~done], alive[~done]
+
+    return enc, self.classifier(enc), exit_layer
+
+  def packed_forward(self, X, get_encoding=False):
+
+    '''
+      forward over packs made by PackedCollate, one output per tweet taken from its first token state.
+    '''
+    if self.language[-1] == '_':
+      raise ValueError('Adapter encoders do not support packing')
+    ids = {k: X[k].to(device=self.device) for k in ('input_ids', 'attention_mask', 'position_ids')}
+
+    autocast = torch.autocast('cpu', dtype=torch.bfloat16) if self.precision == 'bf16' else contextlib.nullcontext()
+    with autocast:
+      # Embeddings and layers are run directly: the models' own mask handling (SDPA) only takes 2-D masks
+      H = self.transformer.embeddings(input_ids=ids['input_ids'], position_ids=ids['position_ids'])
+      mask = self.extended_mask(ids['attention_mask'], H.dtype)
+      for layer in self.transformer.encoder.layer:
+        H = layer(H, attention_mask=mask)[0]
+
+    H = H[X['pack'].to(device=self.device), X['start'].to(device=self.device)].float()
+    enc = self.intermediate(H)
+    output = self.classifier(enc)
+    if get_encoding == True:
+      return enc, output
+
+    return output
+
+  def position_offset(self):
+    '''First position id of a sequence: RoBERTa-style models (BERTweet) count from padding_idx + 1, BERT from 0.'''
+    padding_idx = getattr(self.transformer.embeddings, 'padding_idx', None)
+    return 0 if padding_idx is None else padding_idx + 1
+
+  def freeze(self, layers):
+
+    '''
+      Freeze the embeddings and the first layers transformer layers, all of it (the [CLS] state is then fixed)
+      when layers covers every layer. Frozen parameters stay in the makeOptimizer groups but get no gradients.
+    '''
+    if self.language[-1] == '_':
+      raise ValueError('Adapter encoders cannot be frozen by layers')
+    self.frozen = min(layers, len(self.transformer.encoder.layer))
+    for p in self.transformer.parameters():
+      p.requires_grad = False
+    for layer in self.transformer.encoder.layer[self.frozen:]:
+      for p in layer.parameters():
+        p.requires_grad = True
+
+  def extended_mask(self, mask, dtype):
+    '''Additive attention mask from a (batch, tokens) padding mask or a (batch, tokens, tokens) one.'''
+    mask = mask[:, None, None, :] if mask.dim() == 2 else mask[:, None, :, :]
+    return (1.0 - mask.to(dtype))*torch.finfo(dtype).min
+
+  def backbone_features(self, ids):
+
+    '''
+      Output of the frozen part for tokenized tweets: [CLS] states if the whole transformer is frozen, otherwise
+      the hidden states after the last frozen layer.
+    '''
+    ids = {k: v.to(device=self.device) for k, v in ids.items()}
+    if self.frozen == len(self.transformer.encoder.layer):
+      return self.transformer(**ids)[0][:,0]
+
+    X = self.transformer.embeddings(input_ids=ids['input_ids'])
+    mask = self.extended_mask(ids['attention_mask'], X.dtype)
+    for layer in self.transformer.encoder.layer[:self.frozen]:
+      X = layer(X, attention_mask=mask)[0]
+    return X
+
+  def head_forward(self, X, get_encoding=False):
+
+    '''
+      forward from backbone_features, as batched by FeatureCollate.
+    '''
+    if isinstance(X, dict):
+      mask = X['attention_mask'].to(device=self.device)
+      X = X['hidden'].to(device=self.device)
+      extended = self.extended_mask(mask, X.dtype)
+      for layer in self.transformer.encoder.layer[self.frozen:]:
+        X = layer(X, attention_mask=extended)[0]
+      X = X[:,0]
+    else: X = X.to(device=self.device)
+
+    enc = self.intermediate(X.float())
+    output = self.classifier(enc)
+    if get_encoding == True:
+      return enc, output
+
+    return output
+
+  def load_state_dict(self, state_dict, strict=True):
+    layers = {k.split('.')[1] for k in state_dict if k.startswith('exits.')}
+    if len(layers) and self.exits is None:
+      self.add_exits(layers)
+    self._cache_key = None
+    return super(Encoder, self).load_state_dict(state_dict, strict)
+
   def load(self, path):
     self.load_state_dict(torch.load(path, map_location=self.device))
 
   def save(self, path):
     torch.save(self.state_dict(), path)
 
+  def set_precision(self, precision):
+
+    '''
+      Inference precision of the transformer on CPU: fp32, int8 (dynamic quantization of its linear layers) or
+      bf16 (autocast, only on CPUs with native bfloat16, otherwise stays on fp32). The model is moved to CPU.
+      Quantization cannot be undone nor trained, load a fresh Encoder to go back to fp32.
+    '''
+    if precision == 'bf16' and cpu_bf16_supported() == False:
+      print(f'{bcolors.WARNING}Warning: This CPU has no native bfloat16 support, using fp32{bcolors.ENDC}')
+      precision = 'fp32'
+
+    if self.precision == 'int8':
+      if precision != 'int8':
+        raise ValueError('Quantized weights cannot be converted back, load a fresh Encoder')
+      return
+
+    self.device = torch.device("cpu")
+    self.to(device=self.device)
+    self.precision = precision
+    self._cache_key = self.cache_key()
+
+    if precision == 'int8':
+      self.transformer = torch.quantization.quantize_dynamic(self.transformer, {torch.nn.Linear}, dtype=torch.qint8)
+    self.eval()
+
+  def export_onnx(self, path, opset=14):
+
+    '''
+      Write transformer + intermediate + classifier as an ONNX graph at path, with dynamic batch and sequence axes,
+      alongside the tokenizer (path.tokenizer) and the settings OnnxEncoder needs (path.json). Uses the TorchScript
+      exporter, the dynamo one ignores opset.
+    '''
+    if self.language[-1] == '_':
+      raise ValueError('Adapter encoders cannot be exported to ONNX')
+    if self.precision != 'fp32':
+      raise ValueError('Export the fp32 Encoder, ONNX Runtime applies its own graph optimizations')
+
+    self.eval()
+    ids = self.tokenizer(['export example'], return_tensors='pt', padding=True).to(device=self.device)
+    axes = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+      torch.onnx.export(EncoderGraph(self).eval(), (ids['input_ids'], ids['attention_mask']), path, opset_version=opset, dynamo=False,
+                        input_names=['input_ids', 'attention_mask'], output_names=['encoding', 'logits'],
+                        dynamic_axes={'input_ids': axes, 'attention_mask': axes, 'encoding': {0: 'batch'}, 'logits': {0: 'batch'}})
+
+    self.tokenizer.save_pretrained(f'{path}.tokenizer')
+    with open(f'{path}.json', 'w') as f:
+      json.dump({'max_length': self.max_length, 'interm_size': self.interm_neurons, 'language': self.language}, f)
+
+  def cache_key(self):
+
+    '''
+      Hash of everything the intermediate encodings depend on: transformer and intermediate weights and max_length.
+      The classifier head is left out, so retraining only the head keeps cached encodings valid.
+    '''
+    signature = hashlib.sha1(f'{self.max_length}|{self.precision}'.encode('utf-8'))
+    for name, weight in sorted(self.state_dict().items()):
+      if name.startswith('classifier.'):
+        continue
+      signature.update(name.encode('utf-8'))
+      signature.update(weight.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return signature.digest()
+
   def makeOptimizer(self, lr=1e-5, decay=2e-5, multiplier=1, increase=0.1):
 
     if self.language[-1] == '_':
@@ -167,69 +724,474 @@ class Encoder(torch.nn.Module):
 
     params.append({'params':self.intermediate.parameters(), 'lr':lr*multiplier})
     params.append({'params':self.classifier.parameters(), 'lr':lr*multiplier})
+    if self.exits is not None:
+      params.append({'params':self.exits.parameters(), 'lr':lr*multiplier})
 
     return torch.optim.RMSprop(params, lr=lr*multiplier, weight_decay=decay)
 
-  def get_encodings(self, text, batch_size):
+  def get_encodings(self, text, batch_size, out_path=None, cache=None, pack_length=None, threshold=None):
+
+    '''
+      With pack_length, tweets are packed into sequences of up to pack_length tokens (batch_size packs per batch)
+      instead of being padded one per row; encodings match the unpacked ones up to floating point error.
+      With threshold, tweets leave through the exit heads (see early_exit_forward) and the layer each one
+      left at is kept in self.last_exits.
+    '''
+    if threshold is not None:
+      if self.exits is None:
+        raise ValueError('Early exit needs exit heads, see add_exits')
+      if cache is not None or pack_length is not None:
+        raise ValueError('Early exit does not combine with the encoding cache or packing')
+      return self.get_early_exit_encodings(text, batch_size, threshold, out_path)
+
+    if cache is not None:
+      return self.get_cached_encodings(text, batch_size, cache, out_path, pack_length)
 
     self.eval()    
-    text = pd.DataFrame({'tweets': text, 'label': np.zeros((len(text),))})
-    devloader = DataLoader(RawDataset(text, dataframe=True), batch_size=batch_size, shuffle=False, num_workers=4, worker_init_fn=seed_worker)
+    if len(text) == 0:
+      return np.zeros((0, self.interm_neurons), dtype=np.float32), np.zeros((0,), dtype=np.int64)
+    data = TokenizedDataset(pretokenize(self.tokenizer, text, self.max_length))
+    if pack_length is not None:
+      devloader = packed_loader(self.tokenizer, data, batch_size, max(pack_length, self.max_length), self.position_offset())
+      forward = self.packed_forward
+    else:
+      devloader = tokenized_loader(self.tokenizer, data, batch_size, shuffle=False)
+      forward = self.forward
  
-    with torch.no_grad():
-      out = None
-      log = None
-      for k, data in enumerate(devloader, 0):
-        torch.cuda.empty_cache() 
-        inputs = data['tweet']
-
-        dev_out, dev_log = self.forward(inputs, True)
-        if k == 0:
-          out = dev_out
-          log = dev_log
-        else: 
-          out = torch.cat((out, dev_out), 0)
-          log = torch.cat((log, dev_log), 0)
-
-    out = out.cpu().numpy()
-    log = torch.max(log, 1).indices.cpu().numpy() 
+    def step(batch):
+      dev_out, dev_log = forward(batch['tweet'], True)
+      return dev_out, torch.max(dev_log, 1).indices
+
+    out, log = run_inference(devloader, step, len(data), rows=lambda batch: batch['index'].numpy(), out_path=out_path)
     del devloader
     return out, log
 
-def train_Encoder(prefixpath, data_path, language, mode_weigth, dataf = None, splits = 5, epoches = 4, batch_size = 64, max_length = 120, interm_layer_size = 64, lr = 1e-5,  decay=2e-5, multiplier=1, increase=0.1):
+  def get_early_exit_encodings(self, text, batch_size, threshold, out_path=None):
+
+    self.eval()
+    if len(text) == 0:
+      self.last_exits = np.zeros((0,), dtype=np.int64)
+      return np.zeros((0, self.interm_neurons), dtype=np.float32), np.zeros((0,), dtype=np.int64)
+    data = TokenizedDataset(pretokenize(self.tokenizer, text, self.max_length))
+    devloader = tokenized_loader(self.tokenizer, data, batch_size, shuffle=False)
+
+    def step(batch):
+      dev_out, dev_log, layer = self.early_exit_forward(batch['tweet'], threshold)
+      return dev_out, torch.max(dev_log, 1).indices, layer
+
+    out, log, self.last_exits = run_inference(devloader, step, len(data), rows=lambda batch: batch['index'].numpy(), out_path=out_path)
+    del devloader
+    return out, log
+
+  def get_cached_encodings(self, text, batch_size, cache, out_path=None, pack_length=None):
+
+    '''
+      get_encodings through an EncodingCache: repeated tweets are encoded once, tweets already in the cache are
+      not encoded at all, and predictions are recomputed from the encodings with the current classifier head.
+      Every tweet not encoded here counts as a hit, repeats within text included.
+    '''
+    if getattr(self, '_cache_key', None) is None:
+      self._cache_key = self.cache_key()
+
+    keys = cache.keys(self._cache_key, text)
+    first = {}
+    for i, key in enumerate(keys):
+      first.setdefault(key, i)
+    unique = list(first)
+
+    found = cache.get(unique)
+    missing = [key for key in unique if key not in found]
+    cache.hits += len(keys) - len(missing)
+    cache.misses += len(missing)
+    if len(missing):
+      encoded, _ = self.get_encodings([text[first[key]] for key in missing], batch_size, pack_length=pack_length)
+      cache.put(missing, encoded)
+      found.update(zip(missing, encoded))
+
+    if out_path is not None:
+      out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=(len(keys), self.interm_neurons))
+    else: out = np.empty((len(keys), self.interm_neurons), dtype=np.float32)
+    for i, key in enumerate(keys):
+      out[i] = found[key]
+
+    with torch.inference_mode():
+      log = torch.max(self.classifier(torch.from_numpy(np.array(out)).to(self.device)), 1).indices.cpu().numpy()
+    return out, log
+
+class EncoderGraph(torch.nn.Module):
+
+  '''
+    Encoder.forward on token tensors only, the signature torch.onnx.export traces.
+  '''
+  def __init__(self, encoder):
+    super(EncoderGraph, self).__init__()
+    self.encoder = encoder
+
+  def forward(self, input_ids, attention_mask):
+    return self.encoder.forward({'input_ids': input_ids, 'attention_mask': attention_mask}, True)
+
+class OnnxEncoder:
+
+  '''
+    ONNX Runtime backend of an Encoder exported with Encoder.export_onnx, with the same get_encodings contract.
+    threads sets the intra-op thread pool (ONNX Runtime default when None), optimization the graph optimization
+    level ('disable', 'basic', 'extended' or 'all') and optimized_path, if given, saves the optimized graph.
+  '''
+  def __init__(self, path, threads=None, optimization='all', optimized_path=None):
+
+    import onnxruntime as ort
+
+    with open(f'{path}.json') as f:
+      settings = json.load(f)
+    self.max_length = settings['max_length']
+    self.interm_neurons = settings['interm_size']
+    self.tokenizer = AutoTokenizer.from_pretrained(f'{path}.tokenizer')
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = {'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL, 'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+                                        'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED, 'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL}[optimization]
+    if threads is not None:
+      options.intra_op_num_threads = threads
+      options.inter_op_num_threads = 1
+    if optimized_path is not None:
+      options.optimized_model_filepath = optimized_path
+    self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+  def forward(self, ids):
+    encoding, logits = self.session.run(['encoding', 'logits'], {'input_ids': ids['input_ids'].numpy(), 'attention_mask': ids['attention_mask'].numpy()})
+    return torch.from_numpy(encoding), torch.from_numpy(logits)
+
+  def get_encodings(self, text, batch_size, out_path=None, cache=None):
+
+    if cache is not None:
+      raise ValueError('OnnxEncoder does not support the encoding cache')
+    if len(text) == 0:
+      return np.zeros((0, self.interm_neurons), dtype=np.float32), np.zeros((0,), dtype=np.int64)
+    data = TokenizedDataset(pretokenize(self.tokenizer, text, self.max_length))
+    devloader = tokenized_loader(self.tokenizer, data, batch_size, shuffle=False)
+
+    def step(batch):
+      dev_out, dev_log = self.forward(batch['tweet'])
+      return dev_out, torch.max(dev_log, 1).indices
+
+    out, log = run_inference(devloader, step, len(data), rows=lambda batch: batch['index'].numpy(), out_path=out_path)
+    del devloader
+    return out, log
+
+def cache_backbone(model, tokens, batch_size=200, cache_root='logs/cache/backbone'):
+
+  '''
+    Run the frozen part of model (see Encoder.freeze) once over pretokenized tweets and keep its output in a
+    memory-mapped cache keyed by language, backbone name, frozen weights, max_length, frozen layers and token
+    ids. Returns (features, offsets): a (tweets, 768) float32 array of [CLS] states when the whole transformer
+    is frozen, otherwise a (tokens, 768) float16 array of last frozen layer states with the token offsets of
+    every tweet. Frozen layers run in eval mode, without dropout.
+  '''
+  ids, offsets = tokens
+  signature = hashlib.sha1(f'{model.language}|{model.transformer.config._name_or_path}|{model.max_length}|{model.frozen}|'.encode('utf-8'))
+  frozen = [model.transformer.embeddings] + list(model.transformer.encoder.layer[:model.frozen])
+  for name, weight in sorted((f'{k}.{n}', w) for k, part in enumerate(frozen) for n, w in part.state_dict().items()):
+    signature.update(name.encode('utf-8'))
+    signature.update(weight.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+  signature.update(np.ascontiguousarray(ids).tobytes())
+  signature.update(np.ascontiguousarray(offsets).tobytes())
+  path = os.path.join(cache_root, signature.hexdigest())
+  whole = model.frozen == len(model.transformer.encoder.layer)
+
+  if os.path.isfile(os.path.join(path, 'meta.json')) == False:
+    os.makedirs(path, exist_ok=True)
+    model.eval()
+    data = TokenizedDataset(tokens)
+    loader = tokenized_loader(model.tokenizer, data, batch_size, shuffle=False)
+
+    if whole == True:
+      run_inference(loader, lambda batch: model.backbone_features(batch['tweet']), len(data), rows=lambda batch: batch['index'].numpy(),
+                    out_path=os.path.join(path, 'features.npy')).flush()
+    else:
+      out = np.lib.format.open_memmap(os.path.join(path, 'features.npy'), mode='w+', dtype=np.float16, shape=(int(offsets[-1]), model.transformer.config.hidden_size))
+      with torch.inference_mode():
+        for batch in loader:
+          hidden = model.backbone_features(batch['tweet']).cpu().numpy()
+          for k, i in enumerate(batch['index'].numpy()):
+            out[offsets[i]:offsets[i+1]] = hidden[k, :offsets[i+1] - offsets[i]]
+      out.flush()
+      del out
+    del loader
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+      json.dump({'language': model.language, 'max_length': model.max_length, 'frozen': model.frozen, 'tweets': len(data)}, f)
+
+  features = np.load(os.path.join(path, 'features.npy'), mmap_mode='r')
+  return features, (None if whole == True else np.asarray(offsets))
+
+def exit_loss(model, enc, exit_encodings, labels):
+
+  '''
+    Loss of the exit heads: classification through the shared classifier plus regression of the final encoding.
+  '''
+  loss = 0
+  for e in exit_encodings:
+    loss = loss + model.loss_criterion(model.classifier(e).float(), labels) + torch.nn.functional.mse_loss(e.float(), enc.detach().float())
+  return loss
+
+def train_Exits(model, text, labels, epoches=2, batch_size=64, lr=1e-3):
+
+  '''
+    Post hoc training of the exit heads of a trained Encoder (see add_exits), everything else left as it is.
+  '''
+  tokens = pretokenize(model.tokenizer, text, model.max_length)
+  trainloader = tokenized_loader(model.tokenizer, TokenizedDataset(tokens, labels), batch_size, shuffle=True)
+  optimizer = torch.optim.Adam(model.exits.parameters(), lr=lr)
+  batches = len(trainloader)
+
+  for epoch in range(epoches):
+
+    model.eval()
+    model.exits.train()
+    running_loss = 0.0
+    perc = 0
+    for j, data in enumerate(trainloader, 0):
+
+      labels_batch = data['label'].to(model.device)
+      with torch.no_grad():
+        ids = {k: v.to(device=model.device) for k, v in data['tweet'].items()}
+        hidden = model.transformer(**ids, output_hidden_states=True).hidden_states
+        enc = model.intermediate(hidden[-1][:,0])
+
+      model.zero_grad()
+      loss = exit_loss(model, enc, [model.exits[str(l)](hidden[l][:,0]) for l in model.exit_layers], labels_batch)
+      loss.backward()
+      optimizer.step()
+
+      running_loss = loss.item() if j == 0 else (running_loss + loss.item())/2.0
+      if (j+1)*100.0/batches - perc  >= 1 or j == batches-1:
+        perc = (1+j)*100.0/batches
+        print(f'\rExits Epoch:{epoch+1:3d} of {epoches} step {j+1} of {batches}. {perc:.1f}% loss: {running_loss:.3f}', end="")
+    print()
+
+  model.zero_grad()
+  model.eval()
+  del trainloader
+
+def early_exit_report(model, text, labels, thresholds, batch_size=200):
+
+  '''
+    Exit histogram, speedup over the full model, accuracy and cosine similarity to the full encodings per threshold.
+  '''
+  labels = np.asarray(labels)
+  start = time.perf_counter()
+  full, log = model.get_encodings(text, batch_size)
+  base = time.perf_counter() - start
+  base_acc = (log == labels).mean()
+  print(f'{bcolors.BOLD}full model: {len(text)/base:.1f} tweets/s accuracy {base_acc:.4f}{bcolors.ENDC}')
+
+  for threshold in thresholds:
+    start = time.perf_counter()
+    enc, log = model.get_encodings(text, batch_size, threshold=threshold)
+    elapsed = time.perf_counter() - start
+    acc = (log == labels).mean()
+    cosine = ((enc*full).sum(-1)/np.maximum(np.linalg.norm(enc, axis=-1)*np.linalg.norm(full, axis=-1), 1e-12)).mean()
+    layers, counts = np.unique(model.last_exits, return_counts=True)
+    histogram = ' '.join(f'{l}:{c}' for l, c in zip(layers, counts))
+    print(f'threshold {threshold}: speedup {base/elapsed:.2f}x accuracy {acc:.4f} ({acc - base_acc:+.4f}) cosine {cosine:.4f} | exits {histogram}')
+
+def cache_teacher(model, data_path, batch_size=200, cache_root='logs/cache/teacher'):
+
+  '''
+    Intermediate encodings and logits of the Encoder for every tweet of the split at data_path in corpus order,
+    computed once and memory-mapped, keyed by Encoder.cache_key() and the corpus fingerprint.
+  '''
+  key = hashlib.sha1(model.cache_key() + corpus_fingerprint(data_path).encode('utf-8')).hexdigest()[:16]
+  path = os.path.join(cache_root, key)
+
+  if os.path.isfile(os.path.join(path, 'meta.json')) == False:
+    os.makedirs(path, exist_ok=True)
+    encodings, _ = model.get_encodings(load_corpus_cache(data_path).tweets(), batch_size, out_path=os.path.join(path, 'encodings.npy'))
+    logits = np.lib.format.open_memmap(os.path.join(path, 'logits.npy'), mode='w+', dtype=np.float32, shape=(len(encodings), 2))
+    with torch.inference_mode():
+      for i in range(0, len(encodings), 65536):
+        logits[i:i+65536] = model.classifier(torch.from_numpy(np.array(encodings[i:i+65536])).to(model.device)).float().cpu().numpy()
+    logits.flush()
+    del encodings, logits
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+      json.dump({'data_path': data_path}, f)
+
+  return np.load(os.path.join(path, 'encodings.npy'), mmap_mode='r'), np.load(os.path.join(path, 'logits.npy'), mmap_mode='r')
+
+def amp_context(device, enabled):
+
+  '''
+    Autocast for mixed precision training and evaluation: fp16 on GPU, bf16 on CPU.
+  '''
+  if enabled == False:
+    return contextlib.nullcontext()
+  return torch.autocast(device.type, dtype=torch.float16 if device.type == 'cuda' else torch.bfloat16)
+
+def peak_memory(device):
+
+  '''
+    Peak memory in MB: allocated by torch on GPU since the last reset, resident size of the process on CPU.
+  '''
+  if device.type == 'cuda':
+    return torch.cuda.max_memory_allocated(device)/2**20
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+def rng_state():
+  return {'torch': torch.get_rng_state(), 'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+          'numpy': np.random.get_state(), 'random': random.getstate()}
+
+def set_rng_state(state):
+  torch.set_rng_state(state['torch'])
+  if state['cuda'] is not None and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all(state['cuda'])
+  np.random.set_state(state['numpy'])
+  random.setstate(state['random'])
+
+def save_checkpoint(path, state):
+  torch.save(state, f'{path}.tmp')
+  os.replace(f'{path}.tmp', path)
+
+def save_fold_checkpoint(path, settings, history, model, optimizer, scaler, epoch, step, rng, running_loss, acc, finished=False):
+  if finished == True:
+    save_checkpoint(path, {'settings': settings, 'finished': True, 'history': history, 'best_acc': model.best_acc})
+    return
+  save_checkpoint(path, {'settings': settings, 'finished': False, 'history': history, 'best_acc': model.best_acc,
+                         'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scaler': scaler.state_dict(),
+                         'epoch': epoch, 'step': step, 'rng': rng, 'running_loss': running_loss, 'acc': acc})
+
+def data_fingerprint(dataf):
+
+  '''
+    Signature of the training tweets and labels, so a fold checkpoint is only resumed on the data it was made from.
+  '''
+  signature = hashlib.sha1(np.ascontiguousarray(np.asarray(dataf[-1])).tobytes())
+  if isinstance(dataf[0], TweetArray):
+    offsets = np.asarray(dataf[0].offsets, dtype=np.int64)
+    signature.update((offsets - offsets[0]).tobytes())
+    signature.update(np.ascontiguousarray(dataf[0].buffer[offsets[0]:offsets[-1]]).tobytes())
+  else:
+    for t in dataf[0]:
+      signature.update(str(t).encode('utf-8') + b'\0')
+  return signature.hexdigest()
+
+def train_Encoder(prefixpath, data_path, language, mode_weigth, dataf = None, splits = 5, epoches = 4, batch_size = 64, max_length = 120, interm_layer_size = 64, lr = 1e-5,  decay=2e-5, multiplier=1, increase=0.1, amp=False, accumulation=1, checkpoint_steps=None, frozen=None, exits=None):
   
-  skf = StratifiedKFold(n_splits=5, shuffle=True, random_state = 23) 
+  '''
+    amp trains under autocast (fp16 with loss scaling on GPU, bf16 on CPU) and accumulation sums the gradients of
+    that many batches before each optimizer step, for an effective batch of batch_size*accumulation.
+
+    Every fold is trained, its best weights saved at prefixpath_<fold>.pt and the best over all folds at prefixpath.pt.
+    After each epoch (and every checkpoint_steps batches if set) model, optimizer, RNG and loader position are kept
+    at prefixpath_ckpt/fold<fold>.pt, so running again with the same settings skips finished folds and resumes
+    the interrupted one where it stopped. Remove prefixpath_ckpt to start over.
+
+    frozen freezes the embeddings and that many transformer layers (Encoder.freeze). Their output is computed once
+    by cache_backbone, shared by every fold, and only the remaining layers and the heads are trained from it.
+
+    exits adds exit heads after those transformer layers (Encoder.add_exits), trained jointly with the model.
+  '''
+  if exits is not None and frozen is not None:
+    raise ValueError('Exit heads cannot be trained from a frozen backbone cache')
+
+  skf = StratifiedKFold(n_splits=splits, shuffle=True, random_state = 23) 
   history = []
+  tokens = None
+  features = None
+
+  ckpt_dir = f'{prefixpath}_ckpt'
+  os.makedirs(ckpt_dir, exist_ok=True)
+  settings = {'splits': splits, 'epoches': epoches, 'batch_size': batch_size, 'max_length': max_length, 'interm_layer_size': interm_layer_size,
+              'lr': lr, 'decay': decay, 'multiplier': multiplier, 'increase': increase, 'amp': amp, 'accumulation': accumulation, 'frozen': frozen, 'exits': exits, 'data': data_fingerprint(dataf)}
+  states = {}
+  for i in range(splits):
+    path = os.path.join(ckpt_dir, f'fold{i+1}.pt')
+    if os.path.isfile(path):
+      states[i] = torch.load(path, map_location='cpu', weights_only=False)
+      if states[i]['settings'] != settings:
+        print(f'{bcolors.WARNING}Warning: {path} was made with other settings, training fold {i+1} from scratch{bcolors.ENDC}')
+        del states[i]
+  overall_best = max([s['best_acc'] for s in states.values() if s['best_acc'] is not None], default=None)
 
   for i, (train_index, test_index) in enumerate(skf.split(dataf[0], dataf[-1])):  
     
+    ckpt_path = os.path.join(ckpt_dir, f'fold{i+1}.pt')
+    state = states.get(i)
+    if state is not None and state['finished'] == True:
+      history.append(state['history'])
+      print(f'{bcolors.OKBLUE}Fold {i+1} already trained, skipping{bcolors.ENDC}')
+      continue
+
     history.append({'loss': [], 'acc':[], 'dev_loss': [], 'dev_acc': []})
     model = Encoder(interm_layer_size, max_length, language, mode_weigth)
+    if exits is not None:
+      model.add_exits(exits)
     
     optimizer = model.makeOptimizer(lr, decay, multiplier, increase)
-    trainloader = DataLoader(TW_Data([dataf[0][train_index], dataf[1][train_index]]), batch_size=batch_size, shuffle=True, num_workers=4, worker_init_fn=seed_worker)
-    devloader = DataLoader(TW_Data([dataf[0][test_index], dataf[1][test_index]]), batch_size=batch_size, shuffle=True, num_workers=4, worker_init_fn=seed_worker)
+    scaler = torch.cuda.amp.GradScaler(enabled=(amp and model.device.type == 'cuda'))
+    if tokens is None:
+      tokens = pretokenize(model.tokenizer, dataf[0], max_length)
+    if frozen is not None:
+      model.freeze(frozen)
+      if features is None:
+        features, feature_offsets = cache_backbone(model, tokens)
+      trainloader = feature_loader(FeatureDataset(features, feature_offsets, dataf[1], train_index), batch_size, shuffle=True)
+      devloader = feature_loader(FeatureDataset(features, feature_offsets, dataf[1], test_index), batch_size, shuffle=True)
+      forward = model.head_forward
+    else:
+      trainloader = tokenized_loader(model.tokenizer, TokenizedDataset(tokens, dataf[1], train_index), batch_size, shuffle=True)
+      devloader = tokenized_loader(model.tokenizer, TokenizedDataset(tokens, dataf[1], test_index), batch_size, shuffle=True)
+      forward = model
     batches = len(trainloader)
 
-    for epoch in range(epoches):
+    start_epoch, start_step = 0, 0
+    running_loss, acc = 0.0, 0
+    if state is not None:
+      model.load_state_dict(state['model'])
+      optimizer.load_state_dict(state['optimizer'])
+      scaler.load_state_dict(state['scaler'])
+      model.best_acc = state['best_acc']
+      history[-1] = state['history']
+      start_epoch, start_step = state['epoch'], state['step']
+      running_loss, acc = state['running_loss'], state['acc']
+      set_rng_state(state['rng'])
+      print(f'{bcolors.OKBLUE}Resuming fold {i+1} at epoch {start_epoch+1} step {start_step}{bcolors.ENDC}')
+
+    for epoch in range(start_epoch, epoches):
 
-      running_loss = 0.0
       perc = 0
-      acc = 0
+      if epoch != start_epoch or start_step == 0:
+        running_loss = 0.0
+        acc = 0
+      skip = start_step if epoch == start_epoch else 0
+      trainloader.batch_sampler.skip = skip
+      epoch_rng = rng_state()
       
       model.train()
       last_printed = ''
-      for j, data in enumerate(trainloader, 0):
+      if model.device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(model.device)
+      start = time.perf_counter()
+      samples = 0
+      optimizer.zero_grad()
+      for j, data in enumerate(trainloader, skip):
 
         torch.cuda.empty_cache()         
         inputs, labels = data['tweet'], data['label'].to(model.device)      
         
-        optimizer.zero_grad()
-        outputs = model(inputs)
-        loss = model.loss_criterion(outputs, labels)
+        with amp_context(model.device, amp):
+          if exits is not None:
+            outputs, enc, exit_encodings = model.exit_outputs(inputs)
+            loss = model.loss_criterion(outputs.float(), labels) + exit_loss(model, enc, exit_encodings, labels)
+          else:
+            outputs = forward(inputs)
+            loss = model.loss_criterion(outputs.float(), labels)
         
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss/accumulation).backward()
+        if (j+1) % accumulation == 0 or j == batches-1:
+          scaler.step(optimizer)
+          scaler.update()
+          optimizer.zero_grad()
+        samples += len(labels)
 
         # print statistics
         with torch.no_grad():
@@ -244,7 +1206,11 @@ def train_Encoder(prefixpath, data_path, language, mode_weigth, dataf = None, sp
           perc = (1+j)*100.0/batches
           last_printed = f'\rEpoch:{epoch+1:3d} of {epoches} step {j+1} of {batches}. {perc:.1f}% loss: {running_loss:.3f}'
           print(last_printed, end="")
+
+        if checkpoint_steps is not None and (j+1) % checkpoint_steps == 0 and (j+1) % accumulation == 0 and j != batches-1:
+          save_fold_checkpoint(ckpt_path, settings, history[-1], model, optimizer, scaler, epoch, j+1, epoch_rng, running_loss, acc)
       
+      throughput = f' | {samples/(time.perf_counter() - start):.1f} samples/s peak mem: {peak_memory(model.device):.0f} MB'
       model.eval()
       history[-1]['loss'].append(running_loss)
       with torch.no_grad():
@@ -254,7 +1220,8 @@ def train_Encoder(prefixpath, data_path, language, mode_weigth, dataf = None, sp
           torch.cuda.empty_cache() 
           inputs, label = data['tweet'], data['label'].to(model.device)
 
-          dev_out = model(inputs)
+          with amp_context(model.device, amp):
+            dev_out = forward(inputs).float()
           if k == 0:
             out = dev_out
             log = label
@@ -270,21 +1237,28 @@ def train_Encoder(prefixpath, data_path, language, mode_weigth, dataf = None, sp
 
       band = False
       if model.best_acc is None or model.best_acc < dev_acc:
-        model.save(f'{prefixpath}.pt')
-        model.best_acc = dev_acc
+        model.save(f'{prefixpath}_{i+1}.pt')
+        model.best_acc = float(dev_acc)
         band = True
+        if overall_best is None or overall_best < model.best_acc:
+          model.save(f'{prefixpath}.pt')
+          overall_best = model.best_acc
 
-      ep_finish_print = f' acc: {acc:.3f} | dev_loss: {dev_loss:.3f} dev_acc: {dev_acc.reshape(-1)[0]:.3f}'
+      save_fold_checkpoint(ckpt_path, settings, history[-1], model, optimizer, scaler, epoch+1, 0, rng_state(), running_loss, acc,
+                           finished=(epoch+1 == epoches))
+
+      ep_finish_print = f' acc: {acc:.3f} | dev_loss: {dev_loss:.3f} dev_acc: {dev_acc.reshape(-1)[0]:.3f}' + throughput
       if band == True:
         print(bcolors.OKBLUE + bcolors.BOLD + last_printed + ep_finish_print + '\t[Weights Updated]' + bcolors.ENDC)
       else: print(ep_finish_print)  
 
       
-    print(f'{bcolors.OKBLUE}Training Finished{bcolors.ENDC}')
+    print(f'{bcolors.OKBLUE}Fold {i+1} Training Finished{bcolors.ENDC}')
     del trainloader
     del model
     del devloader
-    return history
+
+  return history
 
 
 class Aditive_Attention(torch.nn.Module):
@@ -0,0 +1,92 @@
+#%%
+import os, sys, json
+sys.path.append('../')
+import numpy as np
+from utils import bcolors
+
+'''
+  Local registry of fine-tuned models: weights as safetensors at <root>/<name>.safetensors, read memory-mapped,
+  and the constructor arguments at <root>/<name>.json, so a registered model is rebuilt without loading any
+  pretrained weights first. Works with every class exposing init_args (Encoder, SeqEncoder, LSTMAtt_Classifier
+  and GCN).
+'''
+
+REGISTRY = 'logs/registry'
+
+def weights_fingerprint(path):
+  stat = os.stat(path)
+  return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+def registered(name, weights=None, root=REGISTRY):
+
+  '''
+    Whether name is in the registry and, when weights (.pt) is given and exists, registered from its current version.
+  '''
+  meta = os.path.join(root, f'{name}.json')
+  if os.path.isfile(meta) == False or os.path.isfile(os.path.join(root, f'{name}.safetensors')) == False:
+    return False
+  if weights is None or os.path.isfile(weights) == False:
+    return True
+  with open(meta) as f:
+    return json.load(f)['weights'] == weights_fingerprint(weights)
+
+def register(model, name, weights=None, root=REGISTRY):
+
+  from safetensors.torch import save_file
+
+  os.makedirs(root, exist_ok=True)
+  state = {k: v.detach().cpu().contiguous() for k, v in model.state_dict().items()}
+  save_file(state, os.path.join(root, f'{name}.safetensors.tmp'))
+  os.replace(os.path.join(root, f'{name}.safetensors.tmp'), os.path.join(root, f'{name}.safetensors'))
+
+  with open(os.path.join(root, f'{name}.json'), 'w') as f:
+    json.dump({'class': type(model).__name__, 'args': model.init_args,
+               'weights': weights_fingerprint(weights) if weights is not None else None}, f)
+
+def build(kind, args):
+
+  '''
+    Empty model of class kind: Encoder skips the pretrained transformer and SeqEncoder gets a zero embedding of
+    the saved shape, since the registered weights replace both.
+  '''
+  if kind == 'Encoder':
+    from models.models import Encoder
+    return Encoder(**args, pretrained=False)
+  if kind == 'SeqEncoder':
+    from models.Sequential import SeqEncoder
+    args = dict(args)
+    return SeqEncoder(embedding_matrix_word=np.zeros(args.pop('embedding_shape'), dtype=np.float32), **args)
+  if kind == 'LSTMAtt_Classifier':
+    from models.classifiers import LSTMAtt_Classifier
+    return LSTMAtt_Classifier(**args)
+  if kind == 'GCN':
+    from models.CGNN import GCN
+    return GCN(**args)
+  raise ValueError(f'No registry support for {kind}')
+
+def from_registry(name, root=REGISTRY):
+
+  from safetensors.torch import load_file
+
+  with open(os.path.join(root, f'{name}.json')) as f:
+    meta = json.load(f)
+  model = build(meta['class'], meta['args'])
+  model.load_state_dict(load_file(os.path.join(root, f'{name}.safetensors'), device=str(model.device)))
+  return model
+
+def load_fine_tuned(name, make, weights, root=REGISTRY):
+
+  '''
+    Fine-tuned model name from the registry when registered from the current weights (.pt); otherwise make() it,
+    load weights and register it, so the next run skips the pretrained load and torch.load.
+  '''
+  if registered(name, weights, root):
+    return from_registry(name, root)
+
+  model = make()
+  model.load(weights)
+  try:
+    register(model, name, weights, root)
+  except ImportError:
+    print(f'{bcolors.WARNING}Warning: safetensors is not installed, {name} not registered{bcolors.ENDC}')
+  return model
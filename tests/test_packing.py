@@ -0,0 +1,39 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np, torch, pytest
+from transformers import BertConfig, BertModel, RobertaConfig, RobertaModel
+from models.models import Encoder, PackedCollate, PadCollate
+
+
+def tiny_encoder(transformer, language):
+
+  model = Encoder.__new__(Encoder)
+  torch.nn.Module.__init__(model)
+  model.language, model.precision, model.max_length, model.interm_neurons = language, 'fp32', 32, 8
+  model.transformer = transformer
+  model.intermediate = torch.nn.Sequential(torch.nn.Linear(transformer.config.hidden_size, 8), torch.nn.LeakyReLU())
+  model.classifier = torch.nn.Linear(8, 2)
+  model.device = torch.device('cpu')
+  return model.eval()
+
+
+@pytest.mark.parametrize('name', ['bert', 'roberta'])
+def test_packed_matches_per_tweet(name):
+
+  torch.manual_seed(0)
+  sizes = dict(hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64, vocab_size=100)
+  if name == 'bert':
+    model = tiny_encoder(BertModel(BertConfig(**sizes)), 'ES')
+  else: model = tiny_encoder(RobertaModel(RobertaConfig(**sizes, pad_token_id=1, max_position_embeddings=40)), 'EN')
+
+  rng = np.random.RandomState(0)
+  batch = [{'input_ids': rng.randint(3, 100, size=n), 'label': 0, 'index': k} for k, n in enumerate([5, 12, 3, 20, 7, 9])]
+
+  with torch.no_grad():
+    single = PadCollate(0)(batch)['tweet']
+    expected = model.forward(single, True)[0]
+    packed = PackedCollate(0, 32, model.position_offset())(batch)
+    encodings = model.packed_forward(packed['tweet'], True)[0]
+
+  assert packed['tweet']['input_ids'].shape[0] < len(batch)
+  assert torch.allclose(encodings[torch.argsort(packed['index'])], expected, atol=1e-5)
@@ -0,0 +1,36 @@
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+from torch.utils.data import DataLoader, Dataset
+from models.models import LengthBucketSampler
+
+
+class Lengths(Dataset):
+  def __init__(self, n):
+    self.n = n
+
+  def __len__(self):
+    return self.n
+
+  def __getitem__(self, idx):
+    return idx
+
+
+def epoch(sampler, skip=0):
+  sampler.skip = skip
+  loader = DataLoader(Lengths(len(sampler.lengths)), batch_sampler=sampler, num_workers=4)
+  return [batch.tolist() for batch in loader]
+
+
+def test_resume_skips_trained_batches_with_workers():
+
+  sampler = LengthBucketSampler(np.random.RandomState(0).randint(1, 50, size=100), 10, shuffle=True, pool=2)
+
+  state = np.random.get_state()
+  full = epoch(sampler)
+  np.random.set_state(state)
+  resumed = epoch(sampler, skip=3)
+
+  assert len(full) == 10
+  assert resumed == full[3:]
+  assert sampler.skip == 0 and len(epoch(sampler)) == 10
@@ -1,11 +1,12 @@
 from matplotlib import pyplot as plt
 import pandas as pd, numpy as np, glob
 import xml.etree.ElementTree as XT
-import torch, os
+import torch, os, hashlib
 from fcmeans import FCM
 from sklearn.metrics.pairwise import euclidean_distances, cosine_similarity
 from sklearn.manifold import TSNE
-import json
+import json, re
+from concurrent.futures import ProcessPoolExecutor
 
 class bcolors:
     HEADER = '\033[95m'
@@ -30,19 +31,35 @@ def read_truth(data_path):
 
     return target
 
-def load_Profiling_Data(data_path, labeled=True, w_features = None):
+def parse_author(adr):
+
+    '''
+        Stream one author file with iterparse and keep only the text of the documents under the first
+        child of the root, clearing every element once read so the whole DOM is never held in memory.
+    '''
+    tweets = []
+    depth = 0
+    for event, elem in XT.iterparse(adr, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 2:
+            tweets.append(elem.text)
+            elem.clear()
+        elif depth == 1:
+            break
+    return tweets
+
+def parse_authors(addrs):
+    return [parse_author(adr) for adr in addrs]
+
+def parse_Profiling_Data(data_path, labeled=True, workers=None, chunksize=256):
 
     addrs = np.array(glob.glob(data_path + '/*.xml'));addrs.sort()
 
-    authors = {}
     indx = []
     label = []
-    tweets = []
-    
-    features = []
-    feat = None 
-    if w_features != None:
-      feat = load_mixed_features(w_features)
 
     if labeled == True:
         target = read_truth(data_path)
@@ -52,24 +69,260 @@ def load_Profiling_Data(data_path, labeled=True, w_features = None):
         author = adr[len(data_path)+1: len(adr) - 4]
         if labeled == True:
             label.append(target[author])
-        authors[author] = len(tweets)
         indx.append(author)
-        tweets.append([])
-        if feat != None:
-          features.append(feat[author])
-
-        tree = XT.parse(adr)
-        root = tree.getroot()[0]
-        for twit in root:
-            tweets[-1].append(twit.text)
-        tweets[-1] = np.array(tweets[-1])
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(addrs) <= chunksize:
+        return parse_authors(addrs), indx, label
+
+    # executor.map hands chunks back in submission order, so authors keep the sorted order above
+    chunks = [list(addrs[i:i+chunksize]) for i in range(0, len(addrs), chunksize)]
+    tweets = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in executor.map(parse_authors, chunks):
+            tweets += chunk
+
+    return tweets, indx, label
+
+def corpus_fingerprint(data_path):
+
+    '''
+        Cheap signature of a PAN split: name, size and mtime of every author file and of truth.txt,
+        so any edit, addition or removal in the directory invalidates the cached corpus.
+    '''
+    signature = hashlib.sha1()
+    files = glob.glob(os.path.join(data_path, '*.xml')) + glob.glob(os.path.join(data_path, 'truth.txt'))
+    for adr in sorted(files):
+        st = os.stat(adr)
+        signature.update(f'{os.path.basename(adr)}:{st.st_size}:{st.st_mtime_ns}\n'.encode('utf-8'))
+    return signature.hexdigest()
+
+def bytes_array(data):
+    return np.frombuffer(data, dtype=np.uint8) if len(data) else np.zeros((0,), dtype=np.uint8)
+
+def _load_array(path):
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError: # empty arrays can not be memory-mapped
+        return np.load(path)
+
+class TweetArray:
+
+    '''
+        Read-only sequence of tweets kept as one UTF-8 byte buffer plus offsets, tweet k being
+        buffer[offsets[k]:offsets[k+1]]. Integers return str, contiguous slices are views sharing the
+        buffer and integer or boolean arrays gather a compact copy, so it indexes like the lists and
+        numpy arrays of tweets it replaces.
+    '''
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, twits):
+        encoded = [(i if i is not None else '').encode('utf-8') for i in twits]
+        offsets = np.zeros((len(encoded) + 1,), dtype=np.int64)
+        offsets[1:] = np.cumsum([len(i) for i in encoded])
+        return cls(bytes_array(b''.join(encoded)), offsets.astype(np.int32 if offsets[-1] < 2**31 else np.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def __getitem__(self, idx):
+
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                return TweetArray(self.buffer, self.offsets[start:max(start, stop) + 1])
+            idx = np.arange(start, stop, step)
+
+        if isinstance(idx, (int, np.integer)):
+            idx = int(idx) + (len(self) if idx < 0 else 0)
+            return bytes(self.buffer[self.offsets[idx]:self.offsets[idx+1]]).decode('utf-8')
+
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.nonzero(idx)[0]
+        starts = self.offsets[idx].astype(np.int64)
+        lengths = self.offsets[idx + 1] - starts
+        offsets = np.zeros((len(idx) + 1,), dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return TweetArray(np.array(self.buffer[gather]), offsets.astype(self.offsets.dtype))
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __getstate__(self):
+        # pickle only the bytes this view spans, not the whole shared buffer
+        return {'buffer': np.array(self.buffer[self.offsets[0]:self.offsets[-1]]), 'offsets': self.offsets - self.offsets[0]}
+
+    def __setstate__(self, state):
+        self.buffer = state['buffer']
+        self.offsets = state['offsets']
+
+    def tolist(self):
+        return list(self)
+
+class ProfilingCorpus:
+
+    '''
+        Columnar view of a PAN split as written by build_corpus_cache: every tweet of the split lives in one
+        UTF-8 buffer, tweet_offsets[k]:tweet_offsets[k+1] delimits tweet k and author_offsets[i]:author_offsets[i+1]
+        delimits the tweets of author i. Arrays are memory-mapped, nothing is decoded until it is asked for.
+    '''
+    def __init__(self, path):
+
+        self.path = path
+        self.text = _load_array(os.path.join(path, 'text.npy'))
+        self.tweet_offsets = _load_array(os.path.join(path, 'tweet_offsets.npy'))
+        self.author_offsets = _load_array(os.path.join(path, 'author_offsets.npy'))
+        self.authors = [str(i) for i in np.load(os.path.join(path, 'authors.npy'))]
+        self.labels = np.array(np.load(os.path.join(path, 'labels.npy')))
+
+    def __len__(self):
+        return len(self.authors)
+
+    def tweet(self, k):
+        return bytes(self.text[self.tweet_offsets[k]:self.tweet_offsets[k+1]]).decode('utf-8')
+
+    def author_tweets(self, i):
+        return [self.tweet(k) for k in range(self.author_offsets[i], self.author_offsets[i+1])]
+
+    def tweets(self):
+        return TweetArray(self.text, self.tweet_offsets)
+
+    def author_view(self, i):
+        return TweetArray(self.text, self.tweet_offsets[self.author_offsets[i]:self.author_offsets[i+1] + 1])
+
+    def tweet_labels(self):
+        return np.repeat(self.labels, np.diff(self.author_offsets))
+
+def build_corpus_cache(data_path, cache_path, fingerprint=None):
+
+    labeled = os.path.isfile(os.path.join(data_path, 'truth.txt'))
+    tweets, indx, label = parse_Profiling_Data(data_path, labeled)
+
+    if os.path.isdir(cache_path) == False:
+        os.makedirs(cache_path)
+    meta_path = os.path.join(cache_path, 'meta.json')
+    if os.path.isfile(meta_path):
+        os.remove(meta_path)
+
+    author_offsets = np.zeros((len(tweets) + 1,), dtype=np.int64)
+    tweet_offsets = [0]
+    text = bytearray()
+    for i, author in enumerate(tweets):
+        for twit in author:
+            text += (twit if twit is not None else '').encode('utf-8')
+            tweet_offsets.append(len(text))
+        author_offsets[i+1] = author_offsets[i] + len(author)
+
+    np.save(os.path.join(cache_path, 'text.npy'), bytes_array(bytes(text)))
+    np.save(os.path.join(cache_path, 'tweet_offsets.npy'), np.array(tweet_offsets, dtype=np.int64))
+    np.save(os.path.join(cache_path, 'author_offsets.npy'), author_offsets)
+    np.save(os.path.join(cache_path, 'authors.npy'), np.array(indx, dtype=str))
+    np.save(os.path.join(cache_path, 'labels.npy'), np.array(label if labeled else [-1]*len(indx), dtype=np.int64))
+
+    with open(meta_path, 'w') as meta:
+        json.dump({'source': os.path.abspath(data_path), 'fingerprint': fingerprint or corpus_fingerprint(data_path),
+                  'labeled': labeled, 'authors': len(indx), 'tweets': len(tweet_offsets) - 1}, meta)
+
+    print(f'{bcolors.OKBLUE}Cached {len(indx)} Profiles from {data_path} at {cache_path}{bcolors.ENDC}')
+
+def corpus_cache_path(data_path, cache_root='logs/cache/corpus'):
+    return os.path.join(cache_root, hashlib.sha1(os.path.abspath(data_path).encode('utf-8')).hexdigest()[:16])
+
+def corpus_cache_valid(cache_path, fingerprint):
+
+    if os.path.isfile(os.path.join(cache_path, 'meta.json')) == False:
+        return False
+    with open(os.path.join(cache_path, 'meta.json')) as file:
+        meta = json.load(file)
+    return meta['fingerprint'] == fingerprint
+
+def load_corpus_cache(data_path, cache_root='logs/cache/corpus'):
+
+    '''
+        Memory-map the columnar copy of a PAN split, (re)building it first when it is missing or when
+        the fingerprint of the source directory does not match the one it was built from.
+    '''
+    cache_path = corpus_cache_path(data_path, cache_root)
+    fingerprint = corpus_fingerprint(data_path)
+
+    if corpus_cache_valid(cache_path, fingerprint) == False:
+        build_corpus_cache(data_path, cache_path, fingerprint)
+
+    return ProfilingCorpus(cache_path)
+
+def iter_Profiling_Data(data_path, labeled=True):
+
+    '''
+        Yield (author_id, tweets, label) one author at a time in the same sorted order as load_Profiling_Data.
+        A valid corpus cache is read author by author; otherwise the XML files are streamed as they are
+        parsed, so consumers can start working before the whole split is ingested. label is None when
+        labeled is False.
+    '''
+    cache_path = corpus_cache_path(data_path)
+    if corpus_cache_valid(cache_path, corpus_fingerprint(data_path)):
+        corpus = ProfilingCorpus(cache_path)
+        for i in range(len(corpus)):
+            yield corpus.authors[i], corpus.author_view(i), (corpus.labels[i] if labeled == True else None)
+        return
+
+    addrs = np.array(glob.glob(data_path + '/*.xml'));addrs.sort()
+    if labeled == True:
+        target = read_truth(data_path)
+
+    for adr in addrs:
+        author = adr[len(data_path)+1: len(adr) - 4]
+        yield author, TweetArray.from_strings(parse_author(adr)), (target[author] if labeled == True else None)
+
+def group_by_author(values, author_offsets):
+
+    '''
+        Scatter per tweet rows of a flattened split back to its authors: an (authors, tweets, ...) array when
+        every author has the same number of tweets, as np.array of the per author list would give.
+    '''
+    sizes = np.diff(author_offsets)
+    if len(sizes) and (sizes == sizes[0]).all():
+        return values.reshape((len(sizes), sizes[0]) + values.shape[1:])
+
+    grouped = np.empty((len(sizes),), dtype=object)
+    for i in range(len(sizes)):
+        grouped[i] = values[author_offsets[i]:author_offsets[i+1]]
+    return grouped
+
+def load_Profiling_Data(data_path, labeled=True, w_features = None, with_tweets = True, cache = True):
+
+    feat = None 
+    if w_features != None:
+      feat = load_mixed_features(w_features)
+
+    if cache == True:
+        corpus = load_corpus_cache(data_path)
+        indx = corpus.authors
+        label = list(corpus.labels) if labeled == True else []
+        tweets = [corpus.author_view(i) for i in range(len(corpus))] if with_tweets == True else None
+    else:
+        tweets, indx, label = parse_Profiling_Data(data_path, labeled)
+        tweets = [TweetArray.from_strings(i) for i in tweets]
+
+    features = []
+    if feat != None:
+      features = [feat[author] for author in indx]
     
     if feat is not None:
       return tweets, indx, np.array(label), np.array(features)
     if labeled == True:
         return tweets, indx, np.array(label), None
 
-    print(f'{bcolors.OKBLUE}Loaded {len(tweets)} Profiles{bcolors.ENDC}' )
+    print(f'{bcolors.OKBLUE}Loaded {len(indx)} Profiles{bcolors.ENDC}' )
     return tweets, indx
 
 def plot_training(history, model_name, measure='loss'):
@@ -405,7 +658,7 @@ def copy_pred(file, path):
 
 def read_embedding(path):
 
-  with open(path, mode='rU') as file:
+  with open(path, mode='r', encoding='utf-8') as file:
     embeddings_matrix = None
     dicc = {}
     embed_dim = 0
@@ -426,14 +679,70 @@ def read_embedding(path):
 
     return embeddings_matrix, dicc
 
+def convert_embedding(path):
+
+  '''
+    Write the GloVe text file at path once as a float32 matrix (path.npy) and its vocabulary (path.vocab,
+    one word per line, the line number being the row in the matrix).
+  '''
+  matrix, dicc = read_embedding(path)
+  np.save(path + '.npy', matrix.astype(np.float32))
+
+  vocab = [None]*len(dicc)
+  for word, i in dicc.items():
+    vocab[i] = word
+  with open(path + '.vocab', 'w', encoding='utf-8') as file:
+    file.write('\n'.join(vocab))
+
+  print(f'{bcolors.OKBLUE}Embedding {path} converted to {path}.npy{bcolors.ENDC}')
+
+def load_embedding(path):
+
+  '''
+    Same (matrix, dic) contract as read_embedding but the matrix is memory-mapped from the binary copy
+    written by convert_embedding, so processes on one host share its pages. The binary copy is
+    (re)built when missing or older than the text file.
+  '''
+  if os.path.isfile(path + '.npy') == False or os.path.isfile(path + '.vocab') == False \
+        or os.path.getmtime(path + '.npy') < os.path.getmtime(path):
+    convert_embedding(path)
+
+  matrix = np.load(path + '.npy', mmap_mode='r')
+  with open(path + '.vocab', encoding='utf-8') as file:
+    dicc = {word: i for i, word in enumerate(file.read().split('\n'))}
+
+  return matrix, dicc
+
+def restrict_embedding(matrix, dic, ids):
+
+  '''
+    Keep only the embedding rows referenced by the id matrices in ids (as produced by translate_words with dic).
+    Returns the reduced matrix with one zero OOV row at the end, the remapped dictionary and an old->new id
+    lookup array, so ids computed against dic are translated with remap[ids].
+  '''
+  used = np.unique(np.concatenate([np.unique(i) for i in ids]))
+  used = used[used < len(dic)]
+
+  remap = np.full((len(dic) + 1,), len(used), dtype=np.int32)
+  remap[used] = np.arange(len(used))
+
+  restricted = np.zeros((len(used) + 1, matrix.shape[1]), dtype=np.float32)
+  restricted[:len(used)] = matrix[used]
+  restricted_dic = {word: int(remap[i]) for word, i in dic.items() if remap[i] < len(used)}
+
+  print(f'{bcolors.OKBLUE}Vocabulary restricted to the corpus: {len(used)} of {len(dic)} words{bcolors.ENDC}')
+  return restricted, restricted_dic, remap
+
+
+EMOJI = {':-)': 'smile', '(-:': 'smile', ':)': 'smile', '(:': 'smile', '=]': 'smile', ':]': 'smile',
+          ':d': 'laughing', '8d': 'laughing', 'xd': 'laughing', '=d': 'laughing', ':-d': 'laughing',
+          'x-d': 'laughing', ':(': 'sad', '):': 'sad', ':c': 'sad', ':[': 'sad', ':\'(': 'crying', ':,( ': 'crying',
+          ':"(': 'crying', ':((': 'crying', ':|': 'neutral', '=_=': 'neutral', '-_-': 'neutral', ':-\\': 'neutral',
+          ':O': 'neutral', ':-!': 'neutral'}
 
 def translate_words(twits, dic, seqlen):
 
-  emoji = {':-)': 'smile', '(-:': 'smile', ':)': 'smile', '(:': 'smile', '=]': 'smile', ':]': 'smile',
-            ':d': 'laughing', '8d': 'laughing', 'xd': 'laughing', '=d': 'laughing', ':-d': 'laughing',
-            'x-d': 'laughing', ':(': 'sad', '):': 'sad', ':c': 'sad', ':[': 'sad', ':\'(': 'crying', ':,( ': 'crying',
-            ':"(': 'crying', ':((': 'crying', ':|': 'neutral', '=_=': 'neutral', '-_-': 'neutral', ':-\\': 'neutral',
-            ':O': 'neutral', ':-!': 'neutral'}
+  emoji = EMOJI
 
   kafka = []
   Spl = []
@@ -569,6 +878,119 @@ def translate_words(twits, dic, seqlen):
 
   return txt, kafka, word_count
 
+EMOTICON = re.compile('|'.join(re.escape(k) for k in EMOJI))
+DIGIT = re.compile('[0-9]')
+LETTERS = re.compile('[a-z](?:.*[a-z])?', re.DOTALL)
+REPEATED = re.compile(r'(.)\1+', re.DOTALL)
+
+def translate_token(token, dic):
+
+  '''
+    Ids and normalized pieces translate_words produces for one whitespace separated token. Symbols
+    stripped from the front or back of a word are queued right after it, as translate_words does.
+  '''
+  ids = []
+  text = []
+  pieces = [token]
+  j = 0
+  while j < len(pieces):
+
+    piece = pieces[j]
+    j += 1
+
+    if EMOTICON.search(piece) is not None:
+      piece = 'emoticon'
+    if piece.startswith('@'):
+      piece = 'reference'
+    if piece.startswith('http'):
+      piece = 'url'
+    if DIGIT.search(piece) is not None:
+      continue
+
+    word = LETTERS.search(piece)
+    if word is not None and word.end() - word.start() > 1:
+      front, back = word.start(), word.end()
+      rest = []
+      if front != 0:
+        rest.append(piece[front:back])
+      if back != len(piece):
+        rest.append(piece[back:])
+      pieces[j:j] = rest
+      piece = piece[:front] if front != 0 else piece[:back]
+
+    if piece.startswith('#'):
+      piece = 'hashtag'
+
+    ids.append(dic.get(piece, len(dic)))
+    text.append(piece)
+
+    word = REPEATED.sub(r'\1\1', piece)
+    if word != piece:
+      text.append(word)
+      if dic.get(word) is not None:
+        ids.append(dic[word])
+
+  return ids, text
+
+def translate_tweets(twits, dic, memo):
+
+  translated = []
+  for twit in twits:
+    hs = []
+    text = []
+    for token in twit.lower().replace('\n', ' ').split(' '):
+      if len(token) == 0:
+        continue
+      if token not in memo:
+        memo[token] = translate_token(token, dic)
+      hs += memo[token][0]
+      text += memo[token][1]
+    translated.append((hs, ' '.join(text)))
+  return translated
+
+_worker_dic = None
+_worker_memo = None
+
+def _init_translate_worker(dic):
+  global _worker_dic, _worker_memo
+  _worker_dic = dic
+  _worker_memo = {}
+
+def _translate_chunk(twits):
+  return translate_tweets(twits, _worker_dic, _worker_memo)
+
+def fast_translate_words(twits, dic, seqlen, workers=None, chunksize=4096, dtype=int):
+
+  '''
+    Drop-in replacement of translate_words returning the same (ids, normalized text, length histogram).
+    Tokens are translated once with precompiled patterns and memoized, and large inputs are split in
+    chunks across worker processes that receive the dictionary once at start up.
+  '''
+  workers = workers or os.cpu_count() or 1
+  if workers == 1 or len(twits) <= chunksize:
+    translated = translate_tweets(twits, dic, {})
+  else:
+    translated = []
+    chunks = [twits[i:i+chunksize] for i in range(0, len(twits), chunksize)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_translate_worker, initargs=(dic,)) as executor:
+      for chunk in executor.map(_translate_chunk, chunks):
+        translated += chunk
+
+  word_count = {}
+  for hs, _ in translated:
+    word_count[len(hs)] = word_count.get(len(hs), 0) + 1
+
+  lengths = np.array([min(len(hs), seqlen) for hs, _ in translated], dtype=np.int64)
+  ids = np.fromiter((k for hs, _ in translated for k in hs[:seqlen]), dtype=dtype, count=int(lengths.sum()))
+  rows = np.repeat(np.arange(len(translated)), lengths)
+  cols = np.arange(len(ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+  txt = np.full((len(translated), seqlen), len(dic), dtype=dtype)
+  txt[lengths == 0] = 0
+  txt[rows, cols] = ids
+
+  return txt, [text for _, text in translated], word_count
+
 def translate_char(twits, dic, seqlen):
   Spl = []
   char_count = {}
@@ -601,39 +1023,112 @@ def translate_char(twits, dic, seqlen):
 
   return txt, char_count    
 
-def read_data(data_path, dicc = None, trans = False):
-  addrs = glob.glob(os.path.join(data_path, '*.xml'))
-  author = {}
+def fast_translate_char(twits, dic, seqlen, dtype=int):
 
-  twit_train = []
-  label_train = []
+  '''
+    Vectorized translate_char: all tweets are encoded at once into one byte buffer (every non ASCII
+    character becomes a single '?', which is out of the vocabulary just as it is in translate_char)
+    and mapped through a 256 entry lookup table straight into the preallocated (n, seqlen) output.
+  '''
+  lut = np.full((256,), len(dic), dtype=dtype)
+  for ch, i in dic.items():
+    if len(ch) == 1 and ord(ch) < 128:
+      lut[ord(ch)] = i
 
-  target = read_truth(data_path)
+  lengths = np.fromiter((len(i) for i in twits), dtype=np.int64, count=len(twits))
+  codes = bytes_array(''.join(twits).encode('ascii', errors='replace'))
 
+  truncated = np.minimum(lengths, seqlen)
+  rows = np.repeat(np.arange(len(twits)), truncated)
+  cols = np.arange(truncated.sum()) - np.repeat(np.cumsum(truncated) - truncated, truncated)
 
-  for adr in addrs:
+  txt = np.full((len(twits), seqlen), len(dic), dtype=dtype)
+  txt[rows, cols] = lut[codes[np.repeat(np.cumsum(lengths) - lengths, truncated) + cols]]
 
-      author = adr.split('/')[-1][:-4]
+  size, times = np.unique(lengths, return_counts=True)
+  char_count = {int(i): int(j) for i, j in zip(size, times)}
 
-      tree = XT.parse(adr)
-      root = tree.getroot()[0]
-      for twit in root:
-          twit_train.append(twit.text)
-          label_train.append(target[author])
+  return txt, char_count
 
-  if trans == True:
-    x = np.random.permutation(len(label_train))
-    twit_train = np.array(twit_train)[x]
-    label_train = np.array(label_train)[x]
-    return label_train, twit_train
+def char_dictionary():
 
   dic = {' ': 0}
   for i in range(26):
       dic[chr(i + 97)] = i + 1
   dic['\''] = 27
+  return dic
+
+def dictionary_fingerprint(dic):
+
+  signature = hashlib.sha1()
+  for word, i in dic.items():
+    signature.update(f'{word}\t{i}\n'.encode('utf-8'))
+  return signature.hexdigest()
+
+def load_token_cache(data_path, dic, seqlen_word=120, seqlen_char=200, char_source='kafka', cache_root='logs/cache/tokens'):
+
+  '''
+    Word and char id matrices of every tweet of a split in corpus order, translated once and memory-mapped
+    on later runs. The entry is keyed by the corpus fingerprint, the word dictionary fingerprint, both
+    sequence lengths and whether chars are read from the normalized text (kafka, as read_data does) or
+    from the raw tweets (raw, as the CNN_LSTM_Encoder encode phase does).
+  '''
+  corpus = load_corpus_cache(data_path)
+  key = f'{corpus_fingerprint(data_path)}|{dictionary_fingerprint(dic)}|{seqlen_word}|{seqlen_char}|{char_source}|int32|uint8'
+  cache_path = os.path.join(cache_root, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+  if os.path.isfile(os.path.join(cache_path, 'meta.json')) == False:
+
+    if os.path.isdir(cache_path) == False:
+      os.makedirs(cache_path)
+    twits = corpus.tweets()
+    words, kafka, word_count = fast_translate_words(twits, dic, seqlen_word, dtype=np.int32)
+    chars, char_count = fast_translate_char(kafka if char_source == 'kafka' else twits, char_dictionary(), seqlen_char, dtype=np.uint8)
+
+    np.save(os.path.join(cache_path, 'words.npy'), words)
+    np.save(os.path.join(cache_path, 'chars.npy'), chars)
+    with open(os.path.join(cache_path, 'kafka.txt'), 'w', encoding='utf-8') as file:
+      file.write('\n'.join(kafka))
+    with open(os.path.join(cache_path, 'meta.json'), 'w') as file:
+      json.dump({'key': key, 'word_count': word_count, 'char_count': char_count}, file)
+    print(f'{bcolors.OKBLUE}Cached token ids of {len(twits)} tweets at {cache_path}{bcolors.ENDC}')
+
+  with open(os.path.join(cache_path, 'meta.json')) as file:
+    meta = json.load(file)
+  with open(os.path.join(cache_path, 'kafka.txt'), encoding='utf-8') as file:
+    kafka = file.read().split('\n')
+
+  words = _load_array(os.path.join(cache_path, 'words.npy'))
+  return {'words': words, 'chars': _load_array(os.path.join(cache_path, 'chars.npy')),
+          'labels': corpus.tweet_labels(), 'author_offsets': np.array(corpus.author_offsets),
+          'kafka': kafka if words.shape[0] else [],
+          'word_count': {int(i): j for i, j in meta['word_count'].items()},
+          'char_count': {int(i): j for i, j in meta['char_count'].items()}}
+
+def read_data(data_path, dicc = None, trans = False, cache = True):
+
+  if cache == True and trans == False:
+    tokens = load_token_cache(data_path, dicc, 120, 200)
+    x = np.random.permutation(tokens['words'].shape[0])
+    return tokens['labels'][x], tokens['words'][x, :], tokens['chars'][x, :], tokens['word_count'], tokens['char_count'], tokens['kafka']
+
+  if cache == True:
+    corpus = load_corpus_cache(data_path)
+    twit_train = corpus.tweets()
+    label_train = list(corpus.tweet_labels())
+  else:
+    tweets, _, label = parse_Profiling_Data(data_path)
+    twit_train = TweetArray.from_strings([twit for author in tweets for twit in author])
+    label_train = [label[i] for i in range(len(tweets)) for _ in tweets[i]]
 
-  twit_train, kafka, word_count = translate_words(twit_train, dicc, 120)
-  twitchar_train, char_count = translate_char(kafka, dic, 200)
+  if trans == True:
+    x = np.random.permutation(len(label_train))
+    twit_train = twit_train[x]
+    label_train = np.array(label_train)[x]
+    return label_train, twit_train
+
+  twit_train, kafka, word_count = fast_translate_words(twit_train, dicc, 120, dtype=np.int32)
+  twitchar_train, char_count = fast_translate_char(kafka, char_dictionary(), 200, dtype=np.uint8)
 
   x = np.random.permutation(twit_train.shape[0])
   twit_train = twit_train[x, :]
@@ -643,7 +1138,7 @@ def read_data(data_path, dicc = None, trans = False):
   return label_train, twit_train, twitchar_train, word_count, char_count, kafka
 
 
-def load_mixed_features(path):
+def parse_mixed_features(path):
     data = json.load(open(path))
     features = {}
 
@@ -652,4 +1147,31 @@ def load_mixed_features(path):
             continue
         features[i] = np.clip(np.fromstring(data[i]['xml']['document']['vec'], 'f', sep=','), -10, 10)
 
-    return features
\ No newline at end of file
+    return features
+
+def load_mixed_features(path, cache_root='logs/cache/features'):
+
+    '''
+        Handcrafted features per author. The JSON is parsed once into a clipped float32 (authors, features)
+        matrix plus an author index, and later calls memory-map that matrix until the JSON changes.
+    '''
+    cache_path = os.path.join(cache_root, hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16])
+    st = os.stat(path)
+    fingerprint = f'{st.st_size}:{st.st_mtime_ns}'
+
+    if corpus_cache_valid(cache_path, fingerprint) == False:
+
+        features = parse_mixed_features(path)
+        if os.path.isdir(cache_path) == False:
+            os.makedirs(cache_path)
+        if os.path.isfile(os.path.join(cache_path, 'meta.json')):
+            os.remove(os.path.join(cache_path, 'meta.json'))
+
+        np.save(os.path.join(cache_path, 'features.npy'), np.stack(list(features.values())).astype(np.float32))
+        np.save(os.path.join(cache_path, 'authors.npy'), np.array(list(features.keys()), dtype=str))
+        with open(os.path.join(cache_path, 'meta.json'), 'w') as meta:
+            json.dump({'source': os.path.abspath(path), 'fingerprint': fingerprint}, meta)
+
+    matrix = _load_array(os.path.join(cache_path, 'features.npy'))
+    authors = np.load(os.path.join(cache_path, 'authors.npy'))
+    return {str(author): matrix[i] for i, author in enumerate(authors)}